@@ -1,8 +1,23 @@
 import ecdsa
 import hashlib
+import hmac
 import os
 import time
 
+import numpy as np
+from ecdsa.ellipticcurve import PointJacobi
+
+MAC_PRIME = 2 ** 127 - 1
+MAC_TAG_SIZE = 16
+# Longer messages are compressed with SHA-512 before the polynomial hash, which is a loop over 15 byte blocks
+MAC_DIGEST_THRESHOLD = 4096
+MAC_MIN_SECRET_BYTES = 32
+
+KEY_POLL_INITIAL = 0.01
+KEY_POLL_MAX = 1.0
+
+_public_keys = {}
+
 
 def generate_private_key():
     return ecdsa.SigningKey.generate(curve=ecdsa.SECP256k1)
@@ -27,6 +42,26 @@ def sign(private_key, msg):
     }
 
 
+def load_private_key(party):
+    """
+    Load the persistent identity key of a party, generating and storing it on first use.
+    :param party:
+    :return:
+    """
+    filename = party + '_skey.pem'
+    if os.path.isfile(filename):
+        f = open(filename, 'rb')
+        private_key = ecdsa.SigningKey.from_pem(f.read())
+        f.close()
+        return private_key
+    private_key = generate_private_key()
+    fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    f = os.fdopen(fd, 'wb')
+    f.write(private_key.to_pem())
+    f.close()
+    return private_key
+
+
 def publish_public_key(party, private_key):
     """
     :param party:
@@ -34,21 +69,175 @@ def publish_public_key(party, private_key):
     :return:
     """
     public_key = generate_public_key(private_key)
-    f = open(party + '_pkey.pem', 'wb')
-    f.write(public_key.to_pem())
-    f.close()
+    pem = public_key.to_pem()
+    filename = party + '_pkey.pem'
+    if not os.path.isfile(filename) or _read_file(filename) != pem:
+        # Write to a temporary file first so that a waiting peer never reads a partial key
+        f = open(filename + '.tmp', 'wb')
+        f.write(pem)
+        f.close()
+        os.replace(filename + '.tmp', filename)
     return public_key
 
 
 def get_public_key(party):
     """
+    Wait for the public key of a party to be published and return it. Polls with a short, exponentially growing
+    interval, so it returns almost as soon as the key appears.
     :param party:
     :return:
     """
     filename = party + '_pkey.pem'
+    delay = KEY_POLL_INITIAL
     while not os.path.isfile(filename) or not os.stat(filename).st_size > 0:
-        time.sleep(1)
+        time.sleep(delay)
+        delay = min(2 * delay, KEY_POLL_MAX)
+    return parse_public_key(_read_file(filename))
+
+
+def parse_public_key(pem):
+    """
+    Parse a PEM encoded public key. Parsed keys are cached with precomputed verification tables, so a key is
+    only ever parsed and prepared once per process.
+    """
+    if pem not in _public_keys:
+        public_key = ecdsa.VerifyingKey.from_pem(pem)
+        # Keys parsed from PEM lose the curve order, which the precomputation tables need
+        point = public_key.pubkey.point
+        point = PointJacobi(public_key.curve.curve, point.x(), point.y(), 1, public_key.curve.order, generator=True)
+        public_key = ecdsa.VerifyingKey.from_public_point(point, curve=public_key.curve)
+        public_key.precompute()
+        _public_keys[pem] = public_key
+    return _public_keys[pem]
+
+
+def pin_public_key(party, pem):
+    """
+    Accept a public key received over the classical channel. The first key seen for a party is stored in its
+    <party>_pkey.pem file, later ones have to match it.
+    """
+    filename = party + '_pkey.pem'
+    if os.path.isfile(filename) and _read_file(filename) != pem:
+        raise ecdsa.BadSignatureError('Public key of {} does not match the pinned key'.format(party))
+    if not os.path.isfile(filename):
+        f = open(filename, 'wb')
+        f.write(pem)
+        f.close()
+    return parse_public_key(pem)
+
+
+def _read_file(filename):
     f = open(filename, 'rb')
-    pkey = ecdsa.VerifyingKey.from_pem(f.read())
+    content = f.read()
+    f.close()
+    return content
+
+
+class MacKey(object):
+    """
+    Wegman-Carter authenticator for one direction of the classical channel.
+
+    A tag is a polynomial hash of the message over GF(2^127 - 1), masked with a fresh pad for every message. The
+    hash key and the pads are derived from a pre-shared secret, a per-session nonce and the direction label, so
+    messages must be verified in the order they were signed. It has the same sign/verify interface as the ecdsa
+    keys and can be used wherever a signing or verifying key is expected.
+
+    Messages longer than MAC_DIGEST_THRESHOLD bytes are hashed as their SHA-512 digest, so for them the tag also
+    relies on the collision resistance of SHA-512.
+    """
+
+    def __init__(self, secret, nonce, label):
+        self._hash_key = int.from_bytes(_derive_key(secret, nonce, label, 'hash'), 'big') % MAC_PRIME
+        self._pad_key = _derive_key(secret, nonce, label, 'pad')
+        self._counter = 0
+
+    def sign(self, msg, hashfunc=None):
+        return self._tag(msg)
+
+    def verify(self, signature, msg, hashfunc=None):
+        if not hmac.compare_digest(self._tag(msg), signature):
+            raise ecdsa.BadSignatureError('MAC verification failed')
+        return True
+
+    def _tag(self, msg):
+        pad = hmac.new(self._pad_key, self._counter.to_bytes(8, 'big'), hashlib.sha256).digest()
+        self._counter += 1
+        tag = (_poly_hash(self._hash_key, msg) + int.from_bytes(pad[:MAC_TAG_SIZE], 'big')) % 2 ** (8 * MAC_TAG_SIZE)
+        return tag.to_bytes(MAC_TAG_SIZE, 'big')
+
+
+def _derive_key(secret, nonce, label, purpose):
+    return hmac.new(secret, nonce + (label + '/' + purpose).encode('UTF-8'), hashlib.sha256).digest()
+
+
+def _poly_hash(key, msg):
+    length = len(msg)
+    # The length of the whole message is still hashed last, which keeps digests apart from short messages
+    if length > MAC_DIGEST_THRESHOLD:
+        msg = hashlib.sha512(msg).digest()
+    else:
+        msg = bytes(msg)
+    h = 0
+    for i in range(0, len(msg), 15):
+        # Marker byte on top keeps every block below the prime and distinguishes trailing zero bytes
+        block = int.from_bytes(msg[i:i + 15] + b'\x01', 'little')
+        h = (h + block) * key % MAC_PRIME
+    return (h + length) * key % MAC_PRIME
+
+
+class TranscriptKey(object):
+    """
+    Wraps a signing or verifying key to authenticate the whole transcript of one direction instead of every
+    message.
+
+    sign/verify only fold each message into a running hash and produce/accept an empty signature. The digest of
+    the transcript so far is signed and checked with the wrapped key at every phase boundary, see
+    communication.authenticate_transcript.
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self._hash = hashlib.sha256()
+
+    def sign(self, msg, hashfunc=None):
+        self._update(msg)
+        return b''
+
+    def verify(self, signature, msg, hashfunc=None):
+        self._update(msg)
+        return True
+
+    def checkpoint(self, phase):
+        """
+        Close a protocol phase and return the digest of the transcript up to and including it.
+        """
+        self._update(('PHASE ' + phase).encode('UTF-8'))
+        return self._hash.digest()
+
+    def _update(self, msg):
+        self._hash.update(len(msg).to_bytes(8, 'big'))
+        self._hash.update(msg)
+
+
+def load_mac_secret(filename):
+    """
+    :param filename:
+    :return: the pre-shared MAC secret
+    :raises ValueError: if the secret is too short to key the MAC safely
+    """
+    secret = _read_file(filename)
+    if len(secret) < MAC_MIN_SECRET_BYTES:
+        raise ValueError('MAC secret in {} has {} bytes, it needs at least {}'.format(
+            filename, len(secret), MAC_MIN_SECRET_BYTES))
+    return secret
+
+
+def store_mac_secret(filename, key_bits):
+    """
+    Replace the pre-shared MAC secret with bits of freshly generated key.
+    :param filename:
+    :param key_bits: list or array of key bits
+    """
+    f = open(filename, 'wb')
+    f.write(np.packbits(np.asarray(key_bits) % 2).tobytes())
     f.close()
-    return pkey
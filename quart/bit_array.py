@@ -0,0 +1,211 @@
+import numpy as np
+
+# Number of bits unpacked at a time by operations that would otherwise unpack the whole array
+CHUNK_BITS = 1 << 23
+
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def popcount(data):
+    """
+    :param data: numpy uint8 array
+    :return: numpy array with the number of bits set in every byte
+    """
+    return _POPCOUNT[data]
+
+
+class BitArray(object):
+    """
+    Compact array of bits, stored eight to a byte with the most significant bit first (as numpy.packbits).
+
+    Supports indexing and assignment of single bits, slicing, gathering by an index array, compressing by a
+    boolean mask, XOR, inversion and popcount. Converts to a numpy uint8 array of bits wherever numpy expects an
+    array. All bits past the length are kept at zero.
+    """
+
+    def __init__(self, bits=()):
+        bits = np.asarray(bits, dtype=np.uint8)
+        self._data = np.packbits(bits)
+        self._length = len(bits)
+
+    @classmethod
+    def from_packed(cls, data, length):
+        """
+        :param data: numpy uint8 array or bytes holding the packed bits, taken over without copying if possible
+        :param length: number of bits
+        """
+        bit_array = cls()
+        bit_array._data = np.frombuffer(data, dtype=np.uint8) if isinstance(data, (bytes, bytearray)) else data
+        if not bit_array._data.flags.writeable:
+            bit_array._data = bit_array._data.copy()
+        bit_array._length = length
+        return bit_array
+
+    @classmethod
+    def zeros(cls, length):
+        return cls.from_packed(np.zeros((length + 7) // 8, dtype=np.uint8), length)
+
+    def __len__(self):
+        return self._length
+
+    def __repr__(self):
+        return 'BitArray(length={})'.format(self._length)
+
+    def __eq__(self, other):
+        if not isinstance(other, BitArray):
+            return NotImplemented
+        return self._length == other._length and np.array_equal(self.packed(), other.packed())
+
+    __hash__ = None
+
+    def __array__(self, dtype=None, copy=None):
+        bits = self.to_array()
+        return bits if dtype is None else bits.astype(dtype)
+
+    def __iter__(self):
+        for start in range(0, self._length, CHUNK_BITS):
+            for bit in self._unpack(start, min(start + CHUNK_BITS, self._length)).tolist():
+                yield bit
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self._length)
+            if step < 0:
+                return BitArray(self.to_array()[index])
+            stop = max(start, stop)
+            if step == 1 and start % 8 == 0:
+                return BitArray.from_packed(self._data[start // 8:(stop + 7) // 8].copy(), stop - start)._clear_tail()
+            return BitArray(self._unpack(start, stop)[::step])
+        if isinstance(index, (np.ndarray, list, BitArray)):
+            index = index if isinstance(index, BitArray) else np.asarray(index)
+            if isinstance(index, BitArray) or index.dtype == bool:
+                return self.compress(index)
+            return self.gather(index)
+        if index < 0:
+            index += self._length
+        return int((self._data[self._byte(index)] >> (7 - (index & 7))) & 1)
+
+    def __setitem__(self, index, bit):
+        if index < 0:
+            index += self._length
+        byte = self._byte(index)
+        if bit:
+            self._data[byte] |= np.uint8(1 << (7 - (index & 7)))
+        else:
+            self._data[byte] &= np.uint8(0xFF ^ (1 << (7 - (index & 7))))
+
+    def __xor__(self, other):
+        if len(other) != self._length:
+            raise ValueError('Cannot XOR bit arrays of different lengths')
+        other = other if isinstance(other, BitArray) else BitArray(other)
+        return BitArray.from_packed(self.packed() ^ other.packed(), self._length)
+
+    def __invert__(self):
+        return BitArray.from_packed(~self.packed(), self._length)._clear_tail()
+
+    def flip(self, index):
+        self._data[self._byte(index)] ^= np.uint8(1 << (7 - (index & 7)))
+
+    def append(self, bit):
+        if self._length % 8 == 0:
+            self._reserve(self._length // 8 + 1)
+        self._length += 1
+        if bit:
+            self._data[(self._length - 1) >> 3] |= np.uint8(1 << (7 - ((self._length - 1) & 7)))
+
+    def extend(self, bits):
+        bits = np.asarray(bits, dtype=np.uint8)
+        if len(bits) == 0:
+            return
+        offset = self._length % 8
+        if offset > 0:
+            # Merge with the bits of the last, partially filled byte
+            bits = np.concatenate((self._unpack(self._length - offset, self._length), bits))
+        start = (self._length - offset) // 8
+        packed = np.packbits(bits)
+        self._reserve(start + len(packed))
+        self._data[start:start + len(packed)] = packed
+        self._length = self._length - offset + len(bits)
+
+    def copy(self):
+        return BitArray.from_packed(self.packed().copy(), self._length)
+
+    def gather(self, indices):
+        """
+        :param indices: array of bit positions
+        :return: BitArray of the bits at the given positions, in order
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        return BitArray((self._data[indices >> 3] >> (7 - (indices & 7)).astype(np.uint8)) & 1)
+
+    def compress(self, mask):
+        """
+        :param mask: BitArray or boolean array of the same length, selecting the bits to keep
+        :return: BitArray of the selected bits, in order
+        """
+        if len(mask) != self._length:
+            raise ValueError('Mask length does not match')
+        result = BitArray()
+        for start in range(0, self._length, CHUNK_BITS):
+            stop = min(start + CHUNK_BITS, self._length)
+            if isinstance(mask, BitArray):
+                chunk_mask = mask._unpack(start, stop).astype(bool)
+            else:
+                chunk_mask = np.asarray(mask[start:stop], dtype=bool)
+            result.extend(self._unpack(start, stop)[chunk_mask])
+        return result
+
+    def delete(self, indices):
+        """
+        :return: BitArray without the bits at the given positions
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        mask = ~BitArray.zeros(self._length)
+        np.bitwise_and.at(mask._data, indices >> 3, (0xFF ^ (1 << (7 - (indices & 7)))).astype(np.uint8))
+        return self.compress(mask)
+
+    def count(self):
+        """
+        :return: number of bits set
+        """
+        return int(_POPCOUNT[self.packed()].sum(dtype=np.int64))
+
+    def packed(self):
+        """
+        :return: numpy uint8 array of the packed bits (a view, not a copy)
+        """
+        return self._data[:(self._length + 7) // 8]
+
+    def to_bytes(self):
+        return self.packed().tobytes()
+
+    def to_array(self):
+        """
+        :return: numpy uint8 array with one bit per element
+        """
+        return self._unpack(0, self._length)
+
+    def tolist(self):
+        return self.to_array().tolist()
+
+    def _byte(self, index):
+        if not 0 <= index < self._length:
+            raise IndexError('BitArray index out of range')
+        return index >> 3
+
+    def _unpack(self, start, stop):
+        first = start // 8
+        bits = np.unpackbits(self._data[first:(stop + 7) // 8])
+        return bits[start - 8 * first:stop - 8 * first]
+
+    def _reserve(self, num_bytes):
+        if num_bytes > len(self._data):
+            data = np.zeros(max(num_bytes, 2 * len(self._data)), dtype=np.uint8)
+            data[:len(self._data)] = self._data
+            self._data = data
+
+    def _clear_tail(self):
+        if self._length % 8 > 0:
+            self._data[self._length // 8] &= np.uint8((0xFF << (8 - self._length % 8)) & 0xFF)
+        self._data = self._data[:(self._length + 7) // 8]
+        return self
@@ -1,107 +1,382 @@
 import pickle
 import authentication as auth
+import hmac
 import json
 import socket
+import struct
+import time
+
+import numpy as np
+
+from bit_array import BitArray
 
 
 def bitlist_to_bytes(bitlist):
-    bytelist = b''
-    padded = False
-    for i in range(0, len(bitlist), 8):
-        byte = 0
-        for j in range(0, 8):
-            if i+j == len(bitlist):
-                byte += pow(2, 7-j)
-                padded = True
-                break
-            byte += bitlist[i+j]*pow(2, 7-j)
-        bytelist += bytes([byte])
-    if not padded:
-        bytelist += bytes([pow(2, 7)])
-    return bytelist
+    """
+    Pack a list or array of bits into bytes, most significant bit first. A single 1 bit is appended as a
+    sentinel before zero-padding to a whole byte, so that the receiver can recover the exact length.
+    """
+    if isinstance(bitlist, BitArray):
+        padded = bitlist.copy()
+        padded.append(1)
+        return padded.to_bytes()
+    bits = np.asarray(bitlist, dtype=np.uint8)
+    return np.packbits(np.append(bits, np.uint8(1))).tobytes()
+
+
+def bytes_to_bits(bytelist):
+    """
+    Inverse of bitlist_to_bytes, returning a numpy uint8 array of bits.
+    """
+    bits = np.unpackbits(np.frombuffer(bytelist, dtype=np.uint8))
+    if not bits.any():
+        raise ValueError('Missing padding sentinel')
+    sentinel = len(bits) - 1 - int(np.argmax(bits[::-1]))
+    return bits[:sentinel]
 
 
 def bytes_to_bitlist(bytelist):
-    bitlist = []
-    for byte in bytelist:
-        for i in range(0, 8):
-            if (byte & (1 << 7-i)) > 0:
-                bitlist.append(1)
-            else:
-                bitlist.append(0)
-    for i in reversed(range(0, len(bitlist))):
-        if bitlist[i] == 1:
-            del bitlist[i]
-            return bitlist
+    return bytes_to_bits(bytelist).tolist()
+
+
+def bytes_to_bit_array(bytelist):
+    """
+    Inverse of bitlist_to_bytes, returning a BitArray without unpacking the bits.
+    """
+    packed = np.frombuffer(bytelist, dtype=np.uint8)
+    nonzero = np.flatnonzero(packed)
+    if len(nonzero) == 0:
+        raise ValueError('Missing padding sentinel')
+    last = int(nonzero[-1])
+    # The sentinel is the lowest set bit of the last non-zero byte
+    sentinel_shift = (int(packed[last]) & -int(packed[last])).bit_length() - 1
+    length = 8 * last + 7 - sentinel_shift
+    data = packed[:(length + 7) // 8].copy()
+    if length % 8 > 0:
+        data[-1] ^= np.uint8(1 << sentinel_shift)
+    return BitArray.from_packed(data, length)
+
+
+CONNECT_TIMEOUT = 60.0
+BACKOFF_INITIAL = 0.01
+BACKOFF_MAX = 1.0
+ACK = 'ACK'.encode('UTF-8')
+
+# Binary framing: every frame starts with a message-type tag and the payload length.
+FRAME_HEADER = struct.Struct('!BQ')
+FRAME_MESSAGE = 1
+FRAME_CONTROL = 2
+
+# Signed messages are the signature length, the signature and then the message itself, so that the message is sent
+# from and verified in the buffer it arrives in instead of being copied into and out of a pickle.
+SIGNATURE_HEADER = struct.Struct('!H')
+
+FRAMING_BINARY = 'binary'
+FRAMING_LEGACY = 'legacy'
+
+_channels = {}
+
+
+class Channel(object):
+    """
+    Long-lived, bidirectional classical connection between two parties.
+
+    While a channel is open, send_message/receive_message and friends between the two parties go over it
+    instead of setting up a new TCP connection per message. One side listens on its own port, the other
+    connects to it.
+
+    With binary framing, messages are streamed back-to-back as tagged, length-prefixed frames. With legacy framing
+    the channel does nothing and every message keeps its own connection with the old pickled length header and
+    double ACK. This is only the old wire framing: the messages themselves are those of this version, so both
+    parties must run this version with the same framing.
+    """
+
+    def __init__(self, party, peer_name, listen, framing=FRAMING_BINARY):
+        if framing not in (FRAMING_BINARY, FRAMING_LEGACY):
+            raise ValueError('Unknown framing: {}'.format(framing))
+        self.party = party
+        self.peer_name = peer_name
+        self.listen = listen
+        self.framing = framing
+        self._sock = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def open(self):
+        if self.framing == FRAMING_LEGACY:
+            return self
+        if self.listen:
+            self._sock = _accept(self.party)
         else:
-            del bitlist[i]
+            socket_info = self.party._appNet.getStateFor(self.party.name)['hostDict'][self.peer_name]
+            self._sock = _connect(socket_info)
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        _channels[(self.party.name, self.peer_name)] = self
+        return self
 
+    def close(self):
+        _channels.pop((self.party.name, self.peer_name), None)
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
 
-def _send_message(sender, receiver_name, msg):
-    # print(sender, receiver_name, msg)
-    socket_info = sender._appNet.getStateFor(sender.name)['hostDict'][receiver_name]
-    s = socket.socket()
+    def send(self, buffers, tag=FRAME_MESSAGE):
+        """
+        Send the concatenation of buffers as one frame.
+        """
+        _sendmsg_all(self._sock, [FRAME_HEADER.pack(tag, sum(len(buffer) for buffer in buffers))] + buffers)
+
+    def receive_frame(self):
+        """
+        :return: tuple (tag, payload) of the next frame
+        """
+        tag, len_msg = FRAME_HEADER.unpack(_recv_exactly(self._sock, FRAME_HEADER.size))
+        return tag, _recv_exactly(self._sock, len_msg)
+
+    def receive(self, tag=FRAME_MESSAGE):
+        received_tag, msg = self.receive_frame()
+        if received_tag != tag:
+            raise ValueError('Expected frame of type {}, got {}'.format(tag, received_tag))
+        return msg
+
+
+def _get_channel(party_name, peer_name=None):
+    for (local_name, remote_name), channel in _channels.items():
+        if local_name == party_name and (peer_name is None or remote_name == peer_name):
+            return channel
+    return None
+
+
+def _connect(socket_info):
+    """
+    Connect to a peer, backing off exponentially while it is not listening yet.
+    """
+    deadline = time.time() + CONNECT_TIMEOUT
+    delay = BACKOFF_INITIAL
     while True:
+        s = socket.socket()
         try:
             s.connect((socket_info.hostname, socket_info.port))
-            break
-        except Exception as e:
-            continue
+            return s
+        except OSError:
+            s.close()
+            if time.time() + delay > deadline:
+                raise
+            time.sleep(delay)
+            delay = min(2 * delay, BACKOFF_MAX)
 
-    s.send(pickle.dumps(len(msg)))
-    ack = s.recv(32)
-    bytes_sent = 0
-    while bytes_sent < len(msg):
-        bytes_sent += s.send(msg[bytes_sent:])
-    ack = s.recv(32)
-    s.close()
 
-
-def _receive_message(receiver):
+def _accept(receiver):
     socket_info = receiver._appNet.getStateFor(receiver.name)['hostDict'][receiver.name]
     s = socket.socket()
     s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     s.bind((socket_info.hostname, socket_info.port))
     s.listen(1)
     c, addr = s.accept()
-    len_msg = pickle.loads(c.recv(256)) #.decode('utf-8')
-    c.send('ACK'.encode('UTF-8'))
-    msg = b''
-    while len(msg) < len_msg:
-        msg += c.recv(4096)
-    c.send('ACK'.encode('UTF-8'))
-    c.close()
     s.close()
+    return c
+
+
+def _recv_length_header(s):
+    """
+    Receive the pickled length header of a legacy message, however many reads its bytes take to arrive. The peer
+    waits for an ACK before it sends the message itself, so nothing past the header can be read.
+    """
+    header = b''
+    while True:
+        chunk = s.recv(256)
+        if not chunk:
+            raise ConnectionError('Connection closed by peer')
+        header += chunk
+        try:
+            return pickle.loads(header)
+        except (EOFError, pickle.UnpicklingError):
+            continue
+
+
+def _recv_exactly(s, size):
+    """
+    Receive exactly size bytes straight into a preallocated buffer.
+    """
+    msg = bytearray(size)
+    view = memoryview(msg)
+    received = 0
+    while received < size:
+        nbytes = s.recv_into(view[received:])
+        if nbytes == 0:
+            raise ConnectionError('Connection closed by peer')
+        received += nbytes
+    return msg
+
+
+def _sendmsg_all(s, buffers):
+    """
+    Send all buffers with scatter/gather I/O, without concatenating them first.
+    """
+    views = [memoryview(buffer) for buffer in buffers if len(buffer) > 0]
+    while views:
+        sent = s.sendmsg(views)
+        while views and sent >= len(views[0]):
+            sent -= len(views[0])
+            views.pop(0)
+        if sent > 0:
+            views[0] = views[0][sent:]
+
+
+def _send_message(sender, receiver_name, buffers, tag=FRAME_MESSAGE):
+    """
+    Send the concatenation of buffers as one message.
+    """
+    # print(sender, receiver_name, buffers)
+    channel = _get_channel(sender.name, receiver_name)
+    if channel is not None:
+        channel.send(buffers, tag)
+        return
+
+    socket_info = sender._appNet.getStateFor(sender.name)['hostDict'][receiver_name]
+    s = _connect(socket_info)
+    s.sendall(pickle.dumps(sum(len(buffer) for buffer in buffers)))
+    _recv_exactly(s, len(ACK))
+    _sendmsg_all(s, buffers)
+    _recv_exactly(s, len(ACK))
+    s.close()
+
+
+def _receive_message(receiver, tag=FRAME_MESSAGE):
+    channel = _get_channel(receiver.name)
+    if channel is not None:
+        return channel.receive(tag)
+
+    # A connection per message carries no tag to check
+    c = _accept(receiver)
+    len_msg = _recv_length_header(c)
+    c.sendall(ACK)
+    msg = _recv_exactly(c, len_msg)
+    c.sendall(ACK)
+    c.close()
     return msg
 
 
-def dict_to_binary(the_dict):
-    return bytes(list(pickle.dumps(the_dict)))
+def signed_to_buffers(signed):
+    """
+    :param signed: dict from authentication.sign
+    :return: list of buffers to send, which do not copy the message
+    """
+    signature = signed['signature']
+    return [SIGNATURE_HEADER.pack(len(signature)) + signature, signed['msg']]
 
 
-def binary_to_dict(binary):
-    return pickle.loads(binary)
+def binary_to_signed(binary):
+    """
+    Inverse of signed_to_buffers. The message is a memoryview of binary, so it is not copied either.
+    """
+    view = memoryview(binary)
+    if len(view) < SIGNATURE_HEADER.size:
+        raise ValueError('Truncated signed message')
+    signature_end = SIGNATURE_HEADER.size + SIGNATURE_HEADER.unpack_from(view)[0]
+    if len(view) < signature_end:
+        raise ValueError('Truncated signed message')
+    return {
+        'msg': view[signature_end:],
+        'signature': bytes(view[SIGNATURE_HEADER.size:signature_end])
+    }
 
 
 def send_message(sender, receiver, sk, msg):
-    _send_message(sender, receiver, dict_to_binary(auth.sign(sk, str(msg))))
+    _send_message(sender, receiver, signed_to_buffers(auth.sign(sk, str(msg))))
 
 
 def send_binary_list(sender, receiver, sk, list):
-    _send_message(sender, receiver, dict_to_binary(auth.sign(sk, bitlist_to_bytes(list))))
+    _send_message(sender, receiver, signed_to_buffers(auth.sign(sk, bitlist_to_bytes(list))))
+
+
+def send_bytes(sender, receiver, sk, data):
+    _send_message(sender, receiver, signed_to_buffers(auth.sign(sk, memoryview(data).cast('B'))))
+
+
+def send_control(sender, receiver, msg):
+    """
+    Send an unsigned control message, such as a flow-control credit. Anything it influences must be confirmed
+    by a later authenticated message.
+    """
+    _send_message(sender, receiver, [str(msg).encode('UTF-8')], FRAME_CONTROL)
 
 
 def receive_message(receiver, pk):
-    message_dict = binary_to_dict(_receive_message(receiver))
+    message_dict = binary_to_signed(_receive_message(receiver))
     auth.verify(pk, message_dict)
-    return message_dict['msg'].decode('UTF-8')
+    return str(message_dict['msg'], 'UTF-8')
+
+
+def receive_control(receiver):
+    return _receive_message(receiver, FRAME_CONTROL).decode('UTF-8')
 
 
 def receive_list(receiver, pk):
     return json.loads(receive_message(receiver, pk))
 
 
+def receive_bytes(receiver, pk):
+    """
+    :return: memoryview of the received bytes
+    """
+    message_dict = binary_to_signed(_receive_message(receiver))
+    auth.verify(pk, message_dict)
+    return message_dict['msg']
+
+
 def receive_binary_list(receiver, pk):
-    message_dict = binary_to_dict(_receive_message(receiver))
+    message_dict = binary_to_signed(_receive_message(receiver))
     auth.verify(pk, message_dict)
     return bytes_to_bitlist(message_dict['msg'])
+
+
+def receive_bits(receiver, pk):
+    message_dict = binary_to_signed(_receive_message(receiver))
+    auth.verify(pk, message_dict)
+    return bytes_to_bits(message_dict['msg'])
+
+
+def receive_bit_array(receiver, pk):
+    message_dict = binary_to_signed(_receive_message(receiver))
+    auth.verify(pk, message_dict)
+    return bytes_to_bit_array(message_dict['msg'])
+
+
+def exchange_public_keys(party, peer, pkey, send_first):
+    """
+    Swap public keys with the peer over the classical channel instead of waiting for its key file. The received
+    key is pinned, see authentication.pin_public_key.
+    """
+    if send_first:
+        _send_message(party, peer, [pkey.to_pem()], FRAME_CONTROL)
+        pem = bytes(_receive_message(party, FRAME_CONTROL))
+    else:
+        pem = bytes(_receive_message(party, FRAME_CONTROL))
+        _send_message(party, peer, [pkey.to_pem()], FRAME_CONTROL)
+    return auth.pin_public_key(peer, pem)
+
+
+def authenticate_transcript(party, peer, sk, pk, phase, send_first):
+    """
+    At the end of a protocol phase, exchange signed digests of the transcript in both directions and abort if the
+    peer's digest does not match what was received. Does nothing unless sk and pk are TranscriptKeys.
+    """
+    if not isinstance(sk, auth.TranscriptKey):
+        return
+    outgoing = signed_to_buffers(auth.sign(sk.key, sk.checkpoint(phase)))
+    if send_first:
+        _send_message(party, peer, outgoing)
+        incoming = binary_to_signed(_receive_message(party))
+    else:
+        incoming = binary_to_signed(_receive_message(party))
+        _send_message(party, peer, outgoing)
+    expected = pk.checkpoint(phase)
+    auth.verify(pk.key, incoming)
+    if not hmac.compare_digest(incoming['msg'], expected):
+        raise auth.ecdsa.BadSignatureError('Transcript mismatch after {}'.format(phase))
+
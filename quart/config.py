@@ -22,13 +22,63 @@ class Config(object):
 
     def write(self):
         """
-        Write the configuration to the config file in the state dir as specified in the config.
+        Write the configuration to the config file in the state dir as specified in the config. The file is written
+        under a temporary name and moved in place, so that a party loading the config at the same time never reads
+        a half-written file.
         """
-        self.config.filename = os.path.join(os.path.dirname(os.path.realpath(__file__)), FILENAME)
+        filename = os.path.join(os.path.dirname(os.path.realpath(__file__)), FILENAME)
+        self.config.filename = '{}.{}.tmp'.format(filename, os.getpid())
         self.config.write()
+        os.replace(self.config.filename, filename)
+        self.config.filename = filename
 
     def get_correctness_param(self):
         return self.config['params']['correctness']
 
     def get_security_param(self):
         return self.config['params']['security']
+
+    def get_framing(self):
+        return self.config['communication']['framing']
+
+    def get_qubit_window(self):
+        return self.config['qubits']['window']
+
+    def get_sift_chunk(self):
+        return self.config['qubits']['sift_chunk']
+
+    def get_authentication_mode(self):
+        return self.config['authentication']['mode']
+
+    def get_mac_secret_file(self, party):
+        return self.config['authentication']['secret_file'].format(party=party)
+
+    def get_replenish_bits(self):
+        return self.config['authentication']['replenish_bits']
+
+    def get_transcript_authentication(self):
+        return self.config['authentication']['transcript']
+
+    def get_key_exchange(self):
+        return self.config['authentication']['key_exchange']
+
+    def get_batched_error_correction(self):
+        return self.config['error_correction']['batched']
+
+    def get_adaptive_error_correction(self):
+        return self.config['error_correction']['adaptive']
+
+    def get_error_correction_engine(self):
+        return self.config['error_correction']['engine']
+
+    def get_compressed_seed(self):
+        return self.config['privacy_amplification']['compressed_seed']
+
+    def get_privacy_amplification_blocks(self):
+        return self.config['privacy_amplification']['blocks']
+
+    def get_privacy_amplification_workers(self):
+        return self.config['privacy_amplification']['workers']
+
+    def get_encryption_chunk_size(self):
+        return self.config['encryption']['chunk_size']
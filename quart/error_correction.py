@@ -1,144 +1,576 @@
+import hmac
 import json
 import math
-import random
+import os
 
+import numpy as np
+
+import ldpc
 import utils
 import communication
+from bit_array import BitArray
+from fenwick import ParityTree
+
+# Block sizes of the first two passes of adaptive Cascade by estimated QBER, as (highest QBER, first block size,
+# second block size), after the optimized Cascade parameters in the literature: powers of 2 about the inverse of
+# the QBER and four times that. All later passes split the key in two halves.
+ADAPTIVE_BLOCK_SIZES = (
+    (0.0005, 2048, 8192),
+    (0.001, 1024, 4096),
+    (0.002, 512, 2048),
+    (0.004, 256, 1024),
+    (0.008, 128, 512),
+    (0.016, 64, 256),
+    (0.032, 32, 128),
+    (0.064, 16, 64),
+    (0.128, 8, 32),
+    (1.0, 4, 16),
+)
+ADAPTIVE_MAX_PASSES = 14
 
 
-class CascadeAlgorithm(object):
+class ReconciliationEngine(object):
+    """
+    Base of the error correction engines registered in ENGINES. An engine corrects the receiver's sifted key to
+    match the sender's, and counts the bits of the key it disclosed (leaked_bits) and the number of times it had to
+    wait for an answer from the peer (round_trips).
+    """
 
-    def __init__(self, party):
+    def __init__(self, party, peer, peer_pkey, batched=False, adaptive=False):
+        """
+        :param batched: see CascadeAlgorithm
+        :param adaptive: see CascadeAlgorithm
+        """
         self.party = party
+        self.peer = peer
+        self.peer_pkey = peer_pkey
+        self.batched = batched
+        self.adaptive = adaptive
+        self.leaked_bits = 0
+        self.round_trips = 0
+        self._awaiting_answer = False
 
     def run_algorithm(self):
         pass
 
-    def _binary(self, block):
+    def _send(self, msg):
+        communication.send_message(self.party.cqc, self.peer, self.party.skey, msg)
+        self._awaiting_answer = True
+
+    def _send_bits(self, bits):
+        communication.send_binary_list(self.party.cqc, self.peer, self.party.skey, bits)
+        self._awaiting_answer = True
+
+    def _receive(self):
+        self._count_round_trip()
+        return communication.receive_message(self.party.cqc, self.peer_pkey)
+
+    def _receive_bits(self):
+        """
+        :return: numpy uint8 array of bits
+        """
+        self._count_round_trip()
+        return communication.receive_bits(self.party.cqc, self.peer_pkey)
+
+    def _count_round_trip(self):
+        if self._awaiting_answer:
+            self.round_trips += 1
+            self._awaiting_answer = False
+
+    def _run_fallback(self, engine):
+        engine.run_algorithm()
+        self.leaked_bits += engine.leaked_bits
+        self.round_trips += engine.round_trips
+
+
+class CascadeAlgorithm(ReconciliationEngine):
+
+    def __init__(self, party, peer, peer_pkey, batched=False, adaptive=False):
+        """
+        :param batched: bisect all blocks of a pass with a parity mismatch at once, see CascadeReceiver._batched_binary
+        :param adaptive: take the block sizes from ADAPTIVE_BLOCK_SIZES, which also covers a QBER of 0, and stop as
+        soon as a pass finds no errors and a hash confirms that the keys match
+        """
+        ReconciliationEngine.__init__(self, party, peer, peer_pkey, batched, adaptive)
+        # For every pass: the key indices in the order the pass splits them into blocks, the position of every key
+        # index in that order, the block size and a parity tree over the key bits in that order
+        self.orders = []
+        self.positions = []
+        self.block_sizes = []
+        self.parity_trees = []
+        self.num_corrections = 0
+
+    def _binary(self, iter_num, start, stop):
         pass
 
+    def _num_passes(self):
+        return ADAPTIVE_MAX_PASSES if self.adaptive else 4
+
+    def _block_size(self, iter_num, key_length):
+        if not self.adaptive:
+            return math.ceil(0.73 / self.party.error_estimation) * 2 ** iter_num
+        if iter_num >= 2:
+            return max(1, math.ceil(key_length / 2))
+        block_sizes = next(row[1:] for row in ADAPTIVE_BLOCK_SIZES if self.party.error_estimation <= row[0])
+        return block_sizes[iter_num]
+
+    def _key_hash(self, seed):
+        return utils.key_hash(seed, self.party.sifted_key)
+
+    def _add_pass(self, order, block_size):
+        """
+        Split the key indices, in the given order, into blocks of block_size for a new pass.
+        :return: list of the parities of all blocks of the pass
+        """
+        # Every pass keeps its index tables, which only take half the memory with 32 bit indices
+        index_type = np.int32 if len(order) < 2 ** 31 else np.int64
+        order = np.asarray(order, dtype=index_type)
+        positions = np.empty(len(order), dtype=index_type)
+        positions[order] = np.arange(len(order), dtype=index_type)
+        self.orders.append(order)
+        self.positions.append(positions)
+        self.block_sizes.append(block_size)
+        if len(self.orders) == 1:
+            # The first pass keeps the key order, so its parities can be counted on the packed key
+            self.parity_trees.append(ParityTree(self.party.sifted_key))
+            return utils.block_parities(self.party.sifted_key, block_size).tolist()
+        bits = np.asarray(self.party.sifted_key)[order]
+        self.parity_trees.append(ParityTree(bits))
+        parities = utils.block_parities(bits, block_size)
+        del bits
+        return parities.tolist()
+
+    def _block_range(self, iter_num, block_num):
+        """
+        :return: tuple (start, stop) of the positions of a block in the order of its pass
+        """
+        start = block_num * self.block_sizes[iter_num]
+        return start, min(start + self.block_sizes[iter_num], len(self.orders[iter_num]))
+
+    def _block_of(self, iter_num, index):
+        return int(self.positions[iter_num][index] // self.block_sizes[iter_num])
+
+    def _parity(self, iter_num, start, stop):
+        """
+        :return: parity of the key bits between the positions start and stop in the order of a pass
+        """
+        return self.parity_trees[iter_num].range_parity(start, stop)
+
 
 class CascadeSender(CascadeAlgorithm):
-    def __init__(self, party):
-        CascadeAlgorithm.__init__(self, party)
+    def __init__(self, party, batched=False, adaptive=False):
+        CascadeAlgorithm.__init__(self, party, party.receiver, party.receiver_pkey, batched, adaptive)
 
     def run_algorithm(self):
-        n = math.ceil(0.73/self.party.error_estimation)
-        iterations = [[]]
+        key_length = len(self.party.sifted_key)
+
+        for iter_num in range(self._num_passes()):
+            if iter_num == 0:
+                order = np.arange(key_length)
+            else:
+                # Choose function fi [1...n] -> [1...n/ki] from a fresh seed, which is all the receiver needs to
+                # derive it, and save it as the order of pass iter_num
+                seed = os.urandom(utils.SEED_BYTES)
+                self._send(seed.hex())
+                order = utils.seeded_permutation(seed, key_length)
 
-        # 1st iteration
-        for i in range(0, len(self.party.sifted_key), n):
-            iterations[0].append(list(range(i, min(i + n, len(self.party.sifted_key) - 1))))
+            parities = self._add_pass(order, self._block_size(iter_num, key_length))
+            self._send_bits(parities)
+            self.leaked_bits += len(parities)
 
-        parities = utils.calculate_parities(self.party.sifted_key, iterations[0])
-        communication.send_binary_list(self.party.cqc, self.party.receiver, self.party.skey, parities)
-        msg = communication.receive_message(self.party.cqc, self.party.receiver_pkey)
+            if self.batched:
+                self._answer_parity_queries()
+            else:
+                msg = self._receive()
+                while msg != 'ALL DONE':
+                    if iter_num == 0:
+                        correcting_iter, block_num = 0, int(msg)
+                    else:
+                        correcting_iter, block_num = json.loads(msg)
+                    self._binary(correcting_iter, *self._block_range(correcting_iter, block_num))
+                    msg = self._receive()
+            self.party.authenticate_phase('cascade pass {}'.format(iter_num))
+            if self.adaptive and self._confirm_keys():
+                break
+
+    def _confirm_keys(self):
+        """
+        Answer the receiver's confirmation message at the end of a pass of adaptive Cascade: empty if the pass still
+        corrected errors, otherwise a hash of its key to compare with ours.
+        :return: True if the keys match and Cascade can stop
+        """
+        confirmation = json.loads(self._receive())
+        if confirmation is None:
+            return False
+        self.leaked_bits += 8 * utils.CONFIRMATION_BYTES
+        matched = hmac.compare_digest(self._key_hash(bytes.fromhex(confirmation['seed'])).hex(),
+                                      confirmation['hash'])
+        self._send('MATCH' if matched else 'MISMATCH')
+        return matched
+
+    def _answer_parity_queries(self):
+        """
+        Batched counterpart of _binary: answer each query of the receiver, a list of [pass, block, start, stop]
+        ranges, with the parities of those ranges of the blocks in one message, until it is done with the pass.
+        """
+        msg = self._receive()
         while msg != 'ALL DONE':
-            block_num = int(msg)
-            self._binary(iterations[0][block_num])
-            msg = communication.receive_message(self.party.cqc, self.party.receiver_pkey)
-
-        # nth iteration
-        for iter_num in range(1, 4):
-            n = 2 * n
-            iterations.append([])
-
-            # Choose function fi [1...n] -> [1...n/ki], send and save in iterations[iter_num]
-            temp_indices = list(range(0, len(self.party.sifted_key)))
-            random.shuffle(temp_indices)
-            communication.send_message(self.party.cqc, self.party.receiver, self.party.skey, temp_indices)
-            for i in range(0, len(self.party.sifted_key), n):
-                iterations[iter_num].append(temp_indices[i:min(i + n, len(self.party.sifted_key) - 1)])
-
-            parities = utils.calculate_parities(self.party.sifted_key, iterations[iter_num])
-            communication.send_binary_list(self.party.cqc, self.party.receiver, self.party.skey, parities)
-
-            msg = communication.receive_message(self.party.cqc, self.party.receiver_pkey)
-            while msg != 'ALL DONE':
-                iter_num, block_num = json.loads(msg)
-                self._binary(iterations[iter_num][block_num])
-                msg = communication.receive_message(self.party.cqc, self.party.receiver_pkey)
-        print(self.party.sifted_key)
-
-    def _binary(self, block):
-        first_half_size = math.ceil(len(block) / 2.0)
-        first_half_par = utils.calculate_parity(self.party.sifted_key, block[:first_half_size])
-        communication.send_message(self.party.cqc, self.party.receiver, self.party.skey, first_half_par)
-        msg = communication.receive_message(self.party.cqc, self.party.receiver_pkey)
+            parities = []
+            for iter_num, block_num, start, stop in json.loads(msg):
+                block_start = self._block_range(iter_num, block_num)[0]
+                parities.append(self._parity(iter_num, block_start + start, block_start + stop))
+            self._send_bits(parities)
+            self.leaked_bits += len(parities)
+            msg = self._receive()
+
+    def _binary(self, iter_num, start, stop):
+        first_half_size = math.ceil((stop - start) / 2.0)
+        first_half_par = self._parity(iter_num, start, start + first_half_size)
+        self._send(first_half_par)
+        self.leaked_bits += 1
+        msg = self._receive()
         if msg != 'DONE':
             block_part = int(msg)
             if block_part == 0:
-                self._binary(block[:first_half_size])
+                self._binary(iter_num, start, start + first_half_size)
             else:
-                self._binary(block[first_half_size:])
+                self._binary(iter_num, start + first_half_size, stop)
 
 
 class CascadeReceiver(CascadeAlgorithm):
-    def __init__(self, party):
-        CascadeAlgorithm.__init__(self, party)
+    def __init__(self, party, batched=False, adaptive=False):
+        CascadeAlgorithm.__init__(self, party, party.sender, party.sender_pkey, batched, adaptive)
 
     def run_algorithm(self):
-        n = math.ceil(0.73 / self.party.error_estimation)
-        iterations = [[]]
-
-        # 1st iteration
-        for i in range(0, len(self.party.sifted_key), n):
-            iterations[0].append(list(range(i, min(i + n, len(self.party.sifted_key) - 1))))
-
-        parities = [utils.calculate_parities(self.party.sifted_key, iterations[0])]
-        alice_parities = [communication.receive_binary_list(self.party.cqc, self.party.sender_pkey)]
-
-        for i in range(0, len(alice_parities[0])):
-            if parities[0][i] != alice_parities[0][i]:
-                communication.send_message(self.party.cqc, self.party.sender, self.party.skey, i)
-                self._binary(iterations[0][i])
-                parities[0][i] ^= 1
-        communication.send_message(self.party.cqc, self.party.sender, self.party.skey, 'ALL DONE')
-
-        # nth iteration
-        for iter_num in range(1, 4):
-            n = 2 * n
-            iterations.append([])
-            temp_indices = communication.receive_list(self.party.cqc, self.party.sender_pkey)
-            for i in range(0, len(self.party.sifted_key), n):
-                iterations[iter_num].append(temp_indices[i:min(i + n, len(self.party.sifted_key) - 1)])
-            parities.append(utils.calculate_parities(self.party.sifted_key, iterations[iter_num]))
-            alice_parities.append(communication.receive_binary_list(self.party.cqc, self.party.sender_pkey))
-            for i in range(0, len(alice_parities[iter_num])):
-                blocks_to_process = [(iter_num,i)]
-                while blocks_to_process:
-                    (correcting_iter, correcting_block) = blocks_to_process.pop()
-                    if parities[correcting_iter][correcting_block] != alice_parities[correcting_iter][correcting_block]:
-                        communication.send_message(self.party.cqc, self.party.sender, self.party.skey, [correcting_iter, correcting_block])
-                        corrected_index = self._binary(iterations[correcting_iter][correcting_block])
-                        for i in range(0, iter_num):
-                            block_containing_index = utils.get_num_block_with_index(iterations[correcting_iter], corrected_index)
-                            parities[i][block_containing_index] ^= 1
-                            if i != correcting_iter:
-                                blocks_to_process.append((i, block_containing_index))
-            communication.send_message(self.party.cqc, self.party.sender, self.party.skey, 'ALL DONE')
-        
-        print(self.party.sifted_key)
-
-    def _binary(self, block):
-        alice_first_half_par = int(communication.receive_message(self.party.cqc, self.party.sender_pkey))
-
-        first_half_size = math.ceil(len(block) / 2.0)
-        first_half_par = utils.calculate_parity(self.party.sifted_key, block[:first_half_size])
+        key_length = len(self.party.sifted_key)
+
+        parities = []
+        alice_parities = []
+        mismatched = []
+        for iter_num in range(self._num_passes()):
+            if iter_num == 0:
+                order = np.arange(key_length)
+            else:
+                order = utils.seeded_permutation(bytes.fromhex(self._receive()), key_length)
+            parities.append(self._add_pass(order, self._block_size(iter_num, key_length)))
+            alice_parities.append(self._receive_bits())
+            self.leaked_bits += len(alice_parities[iter_num])
+
+            num_corrections = self.num_corrections
+            if self.batched:
+                self._batched_cascade(parities, alice_parities, mismatched)
+            elif iter_num == 0:
+                for i in range(0, len(alice_parities[0])):
+                    if parities[0][i] != alice_parities[0][i]:
+                        self._send(i)
+                        self._binary(0, *self._block_range(0, i))
+                        parities[0][i] ^= 1
+                self._send('ALL DONE')
+            else:
+                for i in range(0, len(alice_parities[iter_num])):
+                    blocks_to_process = [(iter_num,i)]
+                    while blocks_to_process:
+                        (correcting_iter, correcting_block) = blocks_to_process.pop()
+                        if (parities[correcting_iter][correcting_block] !=
+                                alice_parities[correcting_iter][correcting_block]):
+                            self._send([correcting_iter, correcting_block])
+                            corrected_index = self._binary(correcting_iter,
+                                                           *self._block_range(correcting_iter, correcting_block))
+                            for j in range(0, iter_num + 1):
+                                block_containing_index = self._block_of(j, corrected_index)
+                                parities[j][block_containing_index] ^= 1
+                                if j != correcting_iter:
+                                    blocks_to_process.append((j, block_containing_index))
+                self._send('ALL DONE')
+            self.party.authenticate_phase('cascade pass {}'.format(iter_num))
+            if self.adaptive and self._confirm_keys(self.num_corrections == num_corrections):
+                break
+
+    def _confirm_keys(self, clean_pass):
+        """
+        At the end of a pass of adaptive Cascade, send the sender a hash of the key under a fresh seed if the pass
+        did not correct any errors, and an empty message otherwise.
+        :return: True if the sender confirmed that the keys match and Cascade can stop
+        """
+        if not clean_pass:
+            self._send(json.dumps(None))
+            return False
+        seed = os.urandom(utils.SEED_BYTES)
+        self._send(json.dumps({'seed': seed.hex(), 'hash': self._key_hash(seed).hex()}))
+        self.leaked_bits += 8 * utils.CONFIRMATION_BYTES
+        return self._receive() == 'MATCH'
+
+    def _batched_cascade(self, parities, alice_parities, mismatched):
+        """
+        Correct the key until the parities of all blocks of all passes so far match the sender's. Every round
+        bisects all mismatched blocks of one pass in parallel, which is safe because the blocks of a pass are
+        disjoint; each correction then toggles the parity of the block holding it in every pass, which may make
+        blocks of other passes mismatch again.
+        :param mismatched: list of the sets of mismatched blocks of each pass, extended with the newest pass
+        """
+        iter_num = len(self.orders) - 1
+        mismatched.append({i for i in range(len(alice_parities[iter_num]))
+                           if parities[iter_num][i] != alice_parities[iter_num][i]})
+        while any(mismatched):
+            correcting_iter = next(i for i, blocks in enumerate(mismatched) if blocks)
+            block_nums = sorted(mismatched[correcting_iter])
+            for corrected_index in self._batched_binary(correcting_iter, block_nums):
+                for i in range(0, iter_num + 1):
+                    block_containing_index = self._block_of(i, corrected_index)
+                    parities[i][block_containing_index] ^= 1
+                    mismatched[i] ^= {block_containing_index}
+        self._send('ALL DONE')
+
+    def _batched_binary(self, iter_num, block_nums):
+        """
+        Run BINARY on the given blocks of a pass at once: each round sends the sender the first halves of the
+        remaining ranges of all blocks in one query and gets all their parities back in one message, so it takes
+        log2(block size) round trips however many blocks there are.
+        :return: list of the corrected key indices
+        """
+        searches = []
+        for block_num in block_nums:
+            block_start, block_stop = self._block_range(iter_num, block_num)
+            searches.append((block_num, block_start, 0, block_stop - block_start))
+        corrected = []
+        while searches:
+            for block_num, block_start, start, stop in searches:
+                if stop - start == 1:
+                    corrected.append(self._flip(iter_num, block_start + start))
+            searches = [search for search in searches if search[3] - search[2] > 1]
+            if not searches:
+                break
+            queries = [[iter_num, block_num, start, start + math.ceil((stop - start) / 2.0)]
+                       for block_num, _, start, stop in searches]
+            self._send(json.dumps(queries))
+            alice_half_parities = self._receive_bits()
+            self.leaked_bits += len(alice_half_parities)
+            next_searches = []
+            for (block_num, block_start, start, stop), query, alice_half_par in zip(searches, queries,
+                                                                                    alice_half_parities):
+                half = query[3]
+                if self._parity(iter_num, block_start + start, block_start + half) != alice_half_par:
+                    next_searches.append((block_num, block_start, start, half))
+                else:
+                    next_searches.append((block_num, block_start, half, stop))
+            searches = next_searches
+        return corrected
+
+    def _flip(self, iter_num, position):
+        """
+        Correct the key bit at the given position in the order of a pass, in the key and in the parity tree of every
+        pass.
+        :return: the corrected key index
+        """
+        index = int(self.orders[iter_num][position])
+        self.party.sifted_key.flip(index)
+        self.num_corrections += 1
+        for parity_tree, positions in zip(self.parity_trees, self.positions):
+            parity_tree.flip(int(positions[index]))
+        return index
+
+    def _binary(self, iter_num, start, stop):
+        alice_first_half_par = int(self._receive())
+        self.leaked_bits += 1
+
+        first_half_size = math.ceil((stop - start) / 2.0)
+        first_half_par = self._parity(iter_num, start, start + first_half_size)
 
         if first_half_par != alice_first_half_par:
             if first_half_size == 1:
-                self.party.sifted_key[block[0]] = (self.party.sifted_key[block[0]] + 1) % 2
-                communication.send_message(self.party.cqc, self.party.sender, self.party.skey, 'DONE')
-                return block[0]
+                self._send('DONE')
+                return self._flip(iter_num, start)
+            else:
+                self._send(0)
+                return self._binary(iter_num, start, start + first_half_size)
+        else:
+            if stop - start - first_half_size == 1:
+                self._send('DONE')
+                return self._flip(iter_num, stop - 1)
             else:
-                communication.send_message(self.party.cqc, self.party.sender, self.party.skey, 0)
-                return self._binary(block[:first_half_size])
+                self._send(1)
+                return self._binary(iter_num, start + first_half_size, stop)
+
+
+class WinnowAlgorithm(ReconciliationEngine):
+    """
+    Winnow: split the key into blocks of 2^r bits and compare their parities; for every block whose parity differs,
+    the sender also discloses the r bit Hamming syndrome of the block, from which the receiver locates a single
+    error directly. Every pass shuffles the key with a fresh seed and doubles the block size, and the protocol ends
+    after a pass without any parity mismatch. Each pass takes one round trip.
+    """
+
+    MAX_PASSES = 10
+
+    def _initial_block_size(self):
+        """
+        :return: power of 2 of at least 4 bits that holds about half an error at the estimated QBER
+        """
+        return 2 ** max(2, int(math.floor(math.log(0.5 / self.party.error_estimation, 2))))
+
+    @staticmethod
+    def _blocks(bits, block_size):
+        """
+        :return: 2D numpy array with one block of bits per row, the last one padded with zeros
+        """
+        blocks = np.zeros(math.ceil(len(bits) / block_size) * block_size, dtype=np.uint8)
+        blocks[:len(bits)] = bits
+        return blocks.reshape(-1, block_size)
+
+    @staticmethod
+    def _syndromes(blocks):
+        """
+        :return: numpy array of the Hamming syndromes of the blocks, the XOR of the (1 based) positions of the bits
+        set among the first block_size - 1 bits of every block
+        """
+        positions = np.arange(1, blocks.shape[1], dtype=np.int64)
+        return np.bitwise_xor.reduce(blocks[:, :-1] * positions, axis=1)
+
+    @staticmethod
+    def _syndromes_to_bits(syndromes, syndrome_size):
+        return ((syndromes[:, np.newaxis] >> np.arange(syndrome_size)) & 1).astype(np.uint8).ravel()
+
+    @staticmethod
+    def _bits_to_syndromes(bits, syndrome_size):
+        return np.asarray(bits, dtype=np.int64).reshape(-1, syndrome_size) @ (1 << np.arange(syndrome_size))
+
+
+class WinnowSender(WinnowAlgorithm):
+    def __init__(self, party, batched=False, adaptive=False):
+        WinnowAlgorithm.__init__(self, party, party.receiver, party.receiver_pkey, batched, adaptive)
+
+    def run_algorithm(self):
+        key_length = len(self.party.sifted_key)
+        block_size = self._initial_block_size()
+        order = np.arange(key_length)
+        for iter_num in range(self.MAX_PASSES):
+            if iter_num > 0:
+                seed = os.urandom(utils.SEED_BYTES)
+                self._send(seed.hex())
+                order = utils.seeded_permutation(seed, key_length)
+            blocks = self._blocks(np.asarray(self.party.sifted_key)[order], block_size)
+            self._send_bits(np.bitwise_xor.reduce(blocks, axis=1))
+            self.leaked_bits += len(blocks)
+            mismatched = json.loads(self._receive())
+            if mismatched:
+                syndrome_size = int(math.log(block_size, 2))
+                self._send_bits(self._syndromes_to_bits(self._syndromes(blocks[mismatched]), syndrome_size))
+                self.leaked_bits += syndrome_size * len(mismatched)
+            self.party.authenticate_phase('winnow pass {}'.format(iter_num))
+            if not mismatched:
+                break
+            if block_size < key_length:
+                block_size *= 2
+
+
+class WinnowReceiver(WinnowAlgorithm):
+    def __init__(self, party, batched=False, adaptive=False):
+        WinnowAlgorithm.__init__(self, party, party.sender, party.sender_pkey, batched, adaptive)
+
+    def run_algorithm(self):
+        key_length = len(self.party.sifted_key)
+        block_size = self._initial_block_size()
+        order = np.arange(key_length)
+        for iter_num in range(self.MAX_PASSES):
+            if iter_num > 0:
+                order = utils.seeded_permutation(bytes.fromhex(self._receive()), key_length)
+            blocks = self._blocks(np.asarray(self.party.sifted_key)[order], block_size)
+            alice_parities = self._receive_bits()
+            self.leaked_bits += len(alice_parities)
+            mismatched = np.flatnonzero(np.bitwise_xor.reduce(blocks, axis=1) != alice_parities)
+            self._send(json.dumps(mismatched.tolist()))
+            if len(mismatched) > 0:
+                syndrome_size = int(math.log(block_size, 2))
+                alice_syndromes = self._bits_to_syndromes(self._receive_bits(), syndrome_size)
+                self.leaked_bits += syndrome_size * len(mismatched)
+                # A single error at a covered position shows as its position in the syndrome difference, one in the
+                # last, uncovered bit leaves the syndromes equal
+                difference = alice_syndromes ^ self._syndromes(blocks[mismatched])
+                positions = mismatched * block_size + np.where(difference > 0, difference - 1, block_size - 1)
+                for index in order[positions[positions < key_length]]:
+                    self.party.sifted_key.flip(int(index))
+            self.party.authenticate_phase('winnow pass {}'.format(iter_num))
+            if len(mismatched) == 0:
+                break
+            if block_size < key_length:
+                block_size *= 2
+
+
+class LdpcSender(ReconciliationEngine):
+    """
+    One-way reconciliation: send the syndrome of the sifted key under a random LDPC code with a rate chosen from the
+    estimated QBER, and let the receiver decode its key against it. Falls back to Cascade if no code is good enough
+    for the QBER, the receiver cannot decode, or a hash of the decoded key does not match the sifted key.
+    """
+
+    def __init__(self, party, batched=False, adaptive=False):
+        """
+        :param batched: passed on to Cascade if it is needed
+        :param adaptive: passed on to Cascade if it is needed
+        """
+        ReconciliationEngine.__init__(self, party, party.receiver, party.receiver_pkey, batched, adaptive)
+
+    def run_algorithm(self):
+        key_length = len(self.party.sifted_key)
+        rate = ldpc.choose_rate(self.party.error_estimation)
+        num_rows = 0 if rate is None else math.ceil((1 - rate) * key_length)
+        seed = os.urandom(utils.SEED_BYTES)
+        # Every column needs COLUMN_WEIGHT different rows, which a random matrix with hardly more rows rarely has
+        if num_rows <= ldpc.COLUMN_WEIGHT:
+            num_rows = 0
         else:
-            if len(block) - first_half_size == 1:
-                self.party.sifted_key[block[-1]] = (self.party.sifted_key[block[-1]] + 1) % 2
-                communication.send_message(self.party.cqc, self.party.sender, self.party.skey, 'DONE')
-                return block[-1]
+            try:
+                matrix = ldpc.ParityCheckMatrix(seed, num_rows, key_length)
+            except ValueError:
+                num_rows = 0
+        self._send(json.dumps({'seed': seed.hex(), 'rows': num_rows}))
+        if num_rows > 0:
+            self._send_bits(matrix.syndrome(np.asarray(self.party.sifted_key)))
+            self.leaked_bits += num_rows
+            confirmation = json.loads(self._receive())
+            decoded = confirmation is not None
+            if decoded:
+                self.leaked_bits += 8 * utils.CONFIRMATION_BYTES
+                decoded = hmac.compare_digest(utils.key_hash(bytes.fromhex(confirmation['seed']),
+                                                             self.party.sifted_key).hex(), confirmation['hash'])
+                self._send('MATCH' if decoded else 'MISMATCH')
+        self.party.authenticate_phase('ldpc syndrome')
+        if num_rows == 0 or not decoded:
+            self._run_fallback(CascadeSender(self.party, self.batched, self.adaptive))
+
+
+class LdpcReceiver(ReconciliationEngine):
+    def __init__(self, party, batched=False, adaptive=False):
+        ReconciliationEngine.__init__(self, party, party.sender, party.sender_pkey, batched, adaptive)
+
+    def run_algorithm(self):
+        code = json.loads(self._receive())
+        decoded = None
+        if code['rows'] > 0:
+            matrix = ldpc.ParityCheckMatrix(bytes.fromhex(code['seed']), code['rows'], len(self.party.sifted_key))
+            syndrome = self._receive_bits()
+            self.leaked_bits += code['rows']
+            decoded = matrix.decode(np.asarray(self.party.sifted_key), syndrome, self.party.error_estimation)
+            if decoded is None:
+                self._send(json.dumps(None))
             else:
-                communication.send_message(self.party.cqc, self.party.sender, self.party.skey, 1)
-                return self._binary(block[first_half_size:])
+                # A word with the right syndrome can still differ from the sender's key by a codeword
+                decoded = BitArray(decoded)
+                seed = os.urandom(utils.SEED_BYTES)
+                self._send(json.dumps({'seed': seed.hex(), 'hash': utils.key_hash(seed, decoded).hex()}))
+                self.leaked_bits += 8 * utils.CONFIRMATION_BYTES
+                if self._receive() != 'MATCH':
+                    decoded = None
+        self.party.authenticate_phase('ldpc syndrome')
+        if decoded is None:
+            self._run_fallback(CascadeReceiver(self.party, self.batched, self.adaptive))
+        else:
+            self.party.sifted_key = decoded
+
+
+# Error correction engines by their name in the configuration, as (sender class, receiver class)
+ENGINES = {
+    'cascade': (CascadeSender, CascadeReceiver),
+    'winnow': (WinnowSender, WinnowReceiver),
+    'ldpc': (LdpcSender, LdpcReceiver),
+}
@@ -0,0 +1,54 @@
+import numpy as np
+
+
+class ParityTree(object):
+    """
+    Fenwick tree over an array of bits, with XOR in place of addition: flips a bit and answers the parity of any
+    range of the array in O(log n).
+    """
+
+    def __init__(self, bits):
+        """
+        :param bits: numpy array of bits, copied into the tree
+        """
+        bits = np.asarray(bits, dtype=np.uint8)
+        self._length = len(bits)
+        # Node i (1-based) holds the parity of the bits (i - lowbit(i), i], taken from the prefix parities at once
+        prefix = np.zeros(self._length + 1, dtype=np.uint8)
+        np.bitwise_xor.accumulate(bits, out=prefix[1:])
+        nodes = np.arange(self._length + 1, dtype=np.int32 if self._length < 2 ** 31 else np.int64)
+        nodes -= nodes & -nodes
+        tree = prefix[nodes]
+        del nodes
+        tree ^= prefix
+        del prefix
+        # A bytearray is much faster than a numpy array for the single element accesses of flip and prefix_parity
+        self._tree = bytearray(tree.tobytes())
+
+    def __len__(self):
+        return self._length
+
+    def flip(self, position):
+        if not 0 <= position < self._length:
+            raise IndexError('ParityTree position out of range')
+        node = position + 1
+        while node <= self._length:
+            self._tree[node] ^= 1
+            node += node & -node
+
+    def prefix_parity(self, stop):
+        """
+        :return: parity of the bits before position stop
+        """
+        parity = 0
+        node = stop
+        while node > 0:
+            parity ^= self._tree[node]
+            node -= node & -node
+        return parity
+
+    def range_parity(self, start, stop):
+        """
+        :return: parity of the bits from position start up to, but not including, stop
+        """
+        return self.prefix_parity(stop) ^ self.prefix_parity(start)
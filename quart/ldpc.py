@@ -0,0 +1,113 @@
+import math
+
+import numpy as np
+
+import utils
+
+COLUMN_WEIGHT = 3
+MAX_ITERATIONS = 100
+# Rounds of reshuffling duplicate edges before giving up on a matrix. Large matrices need two or three, but with
+# only a few rows every column needs most of them and the edges may never settle.
+MAX_RESHUFFLES = 100
+# Code rates (1 - syndrome bits / key bits) and the highest estimated QBER each is used for, from the lowest
+# QBER up. Every key bit takes part in COLUMN_WEIGHT parity checks, so the row weight follows from the rate. The
+# limits are about three quarters of the QBER at which decoding 10^4 bit keys started to fail, leaving room for
+# the error of the estimate.
+RATES = (
+    (0.85, 0.008),
+    (0.8, 0.012),
+    (0.75, 0.016),
+    (0.7, 0.022),
+    (0.65, 0.032),
+    (0.6, 0.042),
+    (0.5, 0.06),
+    (0.4, 0.085),
+    (0.3, 0.11),
+)
+# Smallest likelihood magnitude used in the decoder, which keeps the logarithms and arctanh finite
+_EPSILON = 1e-12
+
+
+def choose_rate(qber):
+    """
+    :return: highest rate in RATES suitable for the given QBER, or None if the QBER is too high for all of them
+    """
+    for rate, max_qber in RATES:
+        if qber <= max_qber:
+            return rate
+    return None
+
+
+class ParityCheckMatrix(object):
+    """
+    Sparse random parity check matrix with COLUMN_WEIGHT ones in every column and (almost) the same number in every
+    row, expanded deterministically from a seed so that both parties can build it. Raises ValueError if the edges
+    cannot be placed within MAX_RESHUFFLES rounds, which then happens for both parties.
+    """
+
+    def __init__(self, seed, num_rows, num_columns):
+        self.num_rows = num_rows
+        self.num_columns = num_columns
+        rng = utils.shared_rng(seed)
+        # Deal the COLUMN_WEIGHT edges of every column out to the rows at random, then reshuffle the edges that
+        # landed in a row their column already has
+        self.columns = np.repeat(np.arange(num_columns), COLUMN_WEIGHT)
+        num_edges = COLUMN_WEIGHT * num_columns
+        rows = (np.arange(num_edges) % num_rows)[utils.random_permutation(rng, num_edges)]
+        duplicates = self._duplicate_edges(rows)
+        for _ in range(MAX_RESHUFFLES):
+            if len(duplicates) == 0:
+                break
+            others = utils.random_below(rng, len(rows), len(duplicates))
+            rows[duplicates], rows[others] = rows[others], rows[duplicates]
+            duplicates = self._duplicate_edges(rows)
+        if len(duplicates) > 0:
+            raise ValueError('Could not place the edges of a {}x{} parity check matrix'.format(num_rows, num_columns))
+        self.rows = rows
+
+    def _duplicate_edges(self, rows):
+        by_column = rows.reshape(self.num_columns, COLUMN_WEIGHT)
+        order = np.argsort(by_column, axis=1)
+        sorted_rows = np.take_along_axis(by_column, order, axis=1)
+        repeated = np.zeros(by_column.shape, dtype=bool)
+        repeated[:, 1:] = sorted_rows[:, 1:] == sorted_rows[:, :-1]
+        return (np.nonzero(repeated)[0] * COLUMN_WEIGHT + order[repeated]).astype(np.int64)
+
+    def syndrome(self, bits):
+        """
+        :param bits: numpy array of num_columns bits
+        :return: numpy uint8 array of the num_rows parities
+        """
+        bits = np.asarray(bits, dtype=np.uint8)
+        return (np.bincount(self.rows, weights=bits[self.columns], minlength=self.num_rows).astype(np.int64)
+                & 1).astype(np.uint8)
+
+    def decode(self, bits, syndrome, qber, max_iterations=MAX_ITERATIONS):
+        """
+        Find the word closest to bits with the given syndrome by belief propagation (sum-product in the log domain),
+        updating the messages along all edges at once in every iteration.
+        :param bits: numpy array of the receiver's bits
+        :param syndrome: numpy array of the sender's syndrome
+        :param qber: probability of each bit being flipped
+        :return: numpy uint8 array of the decoded bits, or None if decoding did not converge
+        """
+        bits = np.asarray(bits, dtype=np.uint8)
+        syndrome = np.asarray(syndrome, dtype=np.uint8)
+        qber = min(max(qber, _EPSILON), 0.5 - _EPSILON)
+        prior = (1.0 - 2.0 * bits) * math.log((1 - qber) / qber)
+        syndrome_signs = 1.0 - 2.0 * syndrome[self.rows]
+        check_messages = np.zeros(len(self.rows))
+        for _ in range(max_iterations):
+            totals = prior + check_messages.reshape(self.num_columns, COLUMN_WEIGHT).sum(axis=1)
+            decoded = (totals < 0).astype(np.uint8)
+            if np.array_equal(self.syndrome(decoded), syndrome):
+                return decoded
+            variable_messages = np.tanh(np.clip(totals[self.columns] - check_messages, -40, 40) / 2)
+            magnitudes = np.log(np.maximum(np.abs(variable_messages), _EPSILON))
+            negative = variable_messages < 0
+            row_magnitudes = np.bincount(self.rows, weights=magnitudes, minlength=self.num_rows)
+            row_negative = np.bincount(self.rows, weights=negative, minlength=self.num_rows).astype(np.int64)
+            products = np.minimum(np.exp(row_magnitudes[self.rows] - magnitudes), 1 - _EPSILON)
+            signs = 1.0 - 2.0 * ((row_negative[self.rows] - negative) & 1)
+            check_messages = 2 * np.arctanh(products) * signs * syndrome_signs
+        return None
@@ -0,0 +1,62 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy.fft import irfft, next_fast_len, rfft
+
+
+def toeplitz_hash(column, row, key):
+    """
+    Multiply the Toeplitz matrix with the given first column and first row by the key, mod 2, without building the
+    matrix. Entry (i, j) of the matrix only depends on i - j, so the product is a slice of the convolution of the
+    key with the matrix's diagonals, which takes one FFT of about len(column) + len(key) points.
+    The result is the same as scipy.linalg.toeplitz(column, row) @ key mod 2. The convolution only has integers
+    up to len(key), far below the point where the rounding error of the FFT could reach 1/2.
+    :param column: bits of the first column, len(column) is the length of the result
+    :param row: bits of the first row, len(row) == len(key) and row[0] is ignored like in scipy
+    :param key: numpy array of bits or BitArray
+    :return: numpy uint8 array of len(column) bits
+    """
+    column = np.asarray(column, dtype=np.float64)
+    row = np.asarray(row, dtype=np.float64)
+    key = np.asarray(key, dtype=np.float64)
+    if len(column) == 0 or len(key) == 0:
+        return np.zeros(len(column), dtype=np.uint8)
+    # diagonals[len(key) - 1 + i - j] is entry (i, j) of the matrix
+    diagonals = np.concatenate((row[:0:-1], column))
+    size = next_fast_len(len(diagonals) + len(key) - 1, real=True)
+    product = irfft(rfft(diagonals, size) * rfft(key, size), size)[len(key) - 1:len(key) - 1 + len(column)]
+    return (np.rint(product).astype(np.int64) & 1).astype(np.uint8)
+
+
+def _hash_block(block):
+    return toeplitz_hash(*block)
+
+
+def block_toeplitz_hash(seed, key, output_length, num_blocks=1, workers=0):
+    """
+    Split the key into num_blocks consecutive blocks of (almost) equal length and hash each of them into its share
+    of the output with its own Toeplitz matrix, in a pool of worker processes. The seed holds the first column and
+    then the first row of every block's matrix, so it has output_length + len(key) bits like the seed of a single
+    matrix, and one block is the same as toeplitz_hash.
+    :param seed: bits of the Toeplitz seeds
+    :param key: numpy array of bits or BitArray
+    :param num_blocks: must be the same for both parties
+    :param workers: number of worker processes, 0 for one per CPU. Only one block or worker hashes in this process.
+    :return: numpy uint8 array of output_length bits
+    """
+    seed = np.asarray(seed, dtype=np.uint8)
+    key = np.asarray(key, dtype=np.uint8)
+    blocks = []
+    offset = 0
+    for b in range(num_blocks):
+        output_start, output_stop = output_length * b // num_blocks, output_length * (b + 1) // num_blocks
+        key_start, key_stop = len(key) * b // num_blocks, len(key) * (b + 1) // num_blocks
+        column_stop = offset + output_stop - output_start
+        row_stop = column_stop + key_stop - key_start
+        blocks.append((seed[offset:column_stop], seed[column_stop:row_stop], key[key_start:key_stop]))
+        offset = row_stop
+    if num_blocks == 1 or workers == 1:
+        return np.concatenate([_hash_block(block) for block in blocks])
+    with ProcessPoolExecutor(max_workers=min(workers or os.cpu_count(), num_blocks)) as pool:
+        return np.concatenate(list(pool.map(_hash_block, blocks)))
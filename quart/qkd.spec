@@ -1,3 +1,57 @@
 [params]
 security = float(default=1.0)
-correctness = float(default=2)
\ No newline at end of file
+correctness = float(default=2)
+
+[communication]
+# 'legacy' is the old wire framing, with a pickled length header and a connection per message. It does not make
+# this version compatible with older ones; both parties must use the same framing.
+framing = option('binary', 'legacy', default='binary')
+
+[qubits]
+# Number of qubits the receiver lets the sender have in flight before it has to wait for more credit.
+# Keep it below the simulator's per-node qubit limit. 0 acknowledges every qubit with a signed message.
+window = integer(min=0, default=10)
+# Exchange bases and sift every sift_chunk qubits while they are still being sent. 0 sifts once at the end.
+sift_chunk = integer(min=0, default=0)
+
+[authentication]
+# 'ecdsa' signs every classical message. 'mac' only signs the session parameters with ECDSA and authenticates
+# everything after them with a Wegman-Carter MAC keyed from secret_file. Both parties need the same random
+# secret (at least 32 bytes) in it before the first session; every session replaces it with replenish_bits bits
+# of the key it generates.
+mode = option('ecdsa', 'mac', default='ecdsa')
+secret_file = string(default='{party}.psk')
+replenish_bits = integer(min=256, default=256)
+# Only authenticate a running hash of each direction's transcript at the end of every protocol phase, instead
+# of every single message.
+transcript = boolean(default=False)
+# How to obtain the peer's public key: wait for its <party>_pkey.pem file, or swap keys over the classical channel
+# and pin the first key seen for each party.
+key_exchange = option('file', 'channel', default='file')
+
+[error_correction]
+# Bisect all mismatched Cascade blocks of a pass at once, with one message per bisection round for all of them,
+# instead of one block at a time with two messages per round.
+batched = boolean(default=False)
+# Pick Cascade's block sizes from a table indexed by the estimated QBER, and stop as soon as a pass finds no errors
+# and a hash of both keys confirms they match.
+adaptive = boolean(default=False)
+# Reconciliation engine, see error_correction.ENGINES. 'winnow' corrects blocks with Hamming syndromes in one round
+# trip per pass. 'ldpc' sends a single syndrome of the key under an LDPC code picked for the estimated QBER, and only
+# falls back to Cascade if the receiver cannot decode it.
+engine = option('cascade', 'winnow', 'ldpc', default='cascade')
+
+[privacy_amplification]
+# Only send a short random seed and let both parties expand it into the Toeplitz matrix with SHAKE-256, instead of
+# sending all of the matrix's random bits. The matrix is then only pseudorandom.
+compressed_seed = boolean(default=False)
+# Split the key into this many blocks and hash every block into its share of the final key with its own Toeplitz
+# matrix. A block only hides what was leaked about the key on average, so keep blocks large (millions of bits).
+blocks = integer(min=1, default=1)
+# Processes that hash the blocks in parallel, 0 for one per CPU. Each party uses its own setting.
+workers = integer(min=0, default=0)
+
+[encryption]
+# Memory-map the file and encrypt and send it in messages of chunk_size bytes, which the receiver decrypts and
+# writes to its file as they arrive. 0 reads the whole file and sends it in one message.
+chunk_size = integer(min=0, default=0)
@@ -34,13 +34,13 @@ import random
 import sys
 
 from config import Config
-from scipy.linalg import toeplitz
-from numpy import matmul
 
 from cqc.pythonLib import CQCConnection, qubit
 import communication
+from bit_array import BitArray
 import authentication as auth
-from error_correction import CascadeReceiver
+from error_correction import ENGINES
+from privacy_amplification import block_toeplitz_hash
 
 import utils
 
@@ -55,8 +55,9 @@ class Receiver(object):
         # CQCConnection.__init__(self, name)
         self.cqc = None
         self.name = name
+        self.config = Config()
 
-        self.skey = auth.generate_private_key()
+        self.skey = auth.load_private_key(self.name)
         self.pkey = auth.publish_public_key(self.name, self.skey)
         self.sender = ''
         self.sender_pkey = ''
@@ -64,46 +65,142 @@ class Receiver(object):
         self.correctness_param = 0.0
         self.security_param = 0.0
 
+        self.window = 0
+        self.sift_chunk = 0
+        self.authentication = 'ecdsa'
+        self.batched_error_correction = False
+        self.adaptive_error_correction = False
+        self.error_correction_engine = 'cascade'
+        self.compressed_seed = False
+        self.privacy_amplification_blocks = 1
+        self.encryption_chunk_size = 0
+
         self.msg = ''
         self.n = 0
+        self.key_length = 0
         self.N = 0
 
-        self.raw_key = []
-        self.basis_list = []
-        self.sifted_key = []
-        self.sifted_basis = []
+        self.raw_key = BitArray()
+        self.basis_list = BitArray()
+        self.sifted_key = BitArray()
+        self.sifted_basis = BitArray()
+        self.num_sifted = 0
 
         self.error_estimation = 0.0
+        self.max_key_length = 0.0
 
     def receive(self, sender='Alice'):
         with CQCConnection(self.name) as self.cqc:
             self.cqc.closeClassicalServer()
             self.sender = sender
-            self.sender_pkey = auth.get_public_key(sender)
-
-            config = communication.receive_list(self.cqc, self.sender_pkey)
-            self.n = config['n']
-            self.correctness_param = config['correctness_param']
-            self.security_param = config['security_param']
-            filename = os.path.basename(config['filename'])
-
-            self.N = math.ceil((4 + self.correctness_param) * self.n) + 25
-            self._receive_qubits()
-            self._perform_basis_sift()
-            can_continue = self._perform_error_estimation()
-            if not can_continue:
-                print('Not enough min entropy :(')
-                return
-            self._perform_error_correction()
-            self._perform_privacy_amplification()
-            cyphertext = communication.receive_binary_list(self.cqc, self.sender_pkey)
+
+            with communication.Channel(self.cqc, self.sender, listen=True, framing=self.config.get_framing()):
+                if self.config.get_key_exchange() == 'channel':
+                    self.sender_pkey = communication.exchange_public_keys(self.cqc, self.sender, self.pkey,
+                                                                          send_first=False)
+                else:
+                    self.sender_pkey = auth.get_public_key(sender)
+                self._run_protocol()
+
+    def _run_protocol(self):
+        config = communication.receive_list(self.cqc, self.sender_pkey)
+        self.n = config['n']
+        self.correctness_param = config['correctness_param']
+        self.security_param = config['security_param']
+        self.window = config.get('window', 0)
+        self.sift_chunk = config.get('sift_chunk', 0)
+        self.batched_error_correction = config.get('batched_error_correction', False)
+        self.adaptive_error_correction = config.get('adaptive_error_correction', False)
+        self.error_correction_engine = config.get('error_correction_engine', 'cascade')
+        self.compressed_seed = config.get('compressed_seed', False)
+        self.privacy_amplification_blocks = config.get('privacy_amplification_blocks', 1)
+        self.encryption_chunk_size = config.get('encryption_chunk_size', 0)
+        self.authentication = config.get('authentication', 'ecdsa')
+        self.key_length = self.n + config.get('replenish_bits', 0)
+        filename = os.path.basename(config['filename'])
+        if self.authentication == 'mac':
+            self._start_mac_authentication(bytes.fromhex(config['nonce']))
+        if config.get('transcript', False):
+            self.skey = auth.TranscriptKey(self.skey)
+            self.sender_pkey = auth.TranscriptKey(self.sender_pkey)
+
+        self.N = math.ceil((4 + self.correctness_param) * self.key_length) + 25
+        self._receive_qubits()
+        # No basis may be revealed before what the peer said about the qubits has been authenticated
+        self.authenticate_phase('qubits')
+        self._perform_basis_sift()
+        self.authenticate_phase('sift')
+        can_continue = self._perform_error_estimation()
+        self.authenticate_phase('error estimation')
+        if not can_continue:
+            print('Not enough min entropy :(')
+            return
+        self._perform_error_correction()
+        if self.authentication == 'mac' and not self._confirm_keys():
+            return
+        self._perform_privacy_amplification()
+        self.authenticate_phase('privacy amplification')
+        if self.encryption_chunk_size > 0:
+            # Only move the file in place once the phase is authenticated, as a transcript is only checked then
+            partial_filename = self.name + '-' + filename + '.part'
+            f = open(partial_filename, 'wb')
+            self._receive_encrypted_chunks(f)
+            f.close()
+            self.authenticate_phase('encryption')
+            os.replace(partial_filename, self.name + '-' + filename)
+        else:
+            cyphertext = communication.receive_bytes(self.cqc, self.sender_pkey)
+            self.authenticate_phase('encryption')
             plaintext = self._decrypt(cyphertext)
             print(plaintext)
             f = open(self.name + '-' + filename, 'wb')
             f.write(plaintext)
             f.close()
+        if self.authentication == 'mac':
+            self._replenish_mac_secret()
+
+    def authenticate_phase(self, phase):
+        communication.authenticate_transcript(self.cqc, self.sender, self.skey, self.sender_pkey, phase,
+                                              send_first=False)
+
+    def _start_mac_authentication(self, nonce):
+        secret = auth.load_mac_secret(self.config.get_mac_secret_file(self.name))
+        self.skey = auth.MacKey(secret, nonce, self.name + '->' + self.sender)
+        self.sender_pkey = auth.MacKey(secret, nonce, self.sender + '->' + self.name)
+
+    def _confirm_keys(self):
+        """
+        Send the sender a hash of the reconciled key before privacy amplification and take the bits it reveals from
+        what privacy amplification may keep.
+        :return: True if the sender holds the same key and there is still enough min entropy for the final key
+        """
+        seed = os.urandom(utils.SEED_BYTES)
+        communication.send_message(self.cqc, self.sender, self.skey, json.dumps({
+            'seed': seed.hex(),
+            'hash': utils.key_hash(seed, self.sifted_key).hex()
+        }))
+        matched = communication.receive_message(self.cqc, self.sender_pkey) == 'MATCH'
+        self.authenticate_phase('key confirmation')
+        self.max_key_length -= 8 * utils.CONFIRMATION_BYTES
+        if not matched:
+            print('Reconciled keys differ :(')
+            return False
+        if self.key_length > self.max_key_length:
+            print('Not enough min entropy :(')
+            return False
+        return True
+
+    def _replenish_mac_secret(self):
+        """
+        Tell the sender we are done with the message and replace the MAC secret with the end of the final key.
+        """
+        communication.send_message(self.cqc, self.sender, self.skey, 'DONE')
+        self.authenticate_phase('done')
+        auth.store_mac_secret(self.config.get_mac_secret_file(self.name), self.final_key[self.n:])
 
     def _receive_qubits(self):
+        if self.window > 0:
+            communication.send_control(self.cqc, self.sender, min(self.window, self.N))
         for i in range(0, self.N):
 
             # Receive qubit from Alice (via Eve)
@@ -118,37 +215,57 @@ class Receiver(object):
             # Retrieve key bit
             k = q.measure()
             self.raw_key.append(k)
-            communication.send_message(self.cqc, self.sender, self.skey, 'ok')
-
-        communication.send_message(self.cqc, self.sender, self.skey, 'DONE')
+            if self.window == 0:
+                communication.send_message(self.cqc, self.sender, self.skey, 'ok')
+
+            if self.sift_chunk > 0 and ((i + 1) % self.sift_chunk == 0 or i + 1 == self.N):
+                self._sift_chunk(i + 1)
+
+            if self.window > 0 and (i + 1) % self.window == 0 and i + 1 < self.N:
+                communication.send_control(self.cqc, self.sender, min(self.window, self.N - i - 1))
+
+        if self.window > 0:
+            communication.send_message(self.cqc, self.sender, self.skey, json.dumps({
+                'status': 'DONE',
+                'received': self.N
+            }))
+        else:
+            communication.send_message(self.cqc, self.sender, self.skey, 'DONE')
+
+    def _sift_chunk(self, end):
+        start = self.num_sifted
+        # Send our bases first: as a signed message they show that the chunk has been measured
+        communication.send_binary_list(self.cqc, self.sender, self.skey, self.basis_list[start:end])
+        self.authenticate_phase('qubits {}'.format(end))
+        sender_basis = communication.receive_bit_array(self.cqc, self.sender_pkey)
+
+        sifted_key, sifted_basis = utils.sift(self.raw_key[start:end], self.basis_list[start:end], sender_basis)
+        self.sifted_key.extend(sifted_key)
+        self.sifted_basis.extend(sifted_basis)
+        self.num_sifted = end
 
     def _perform_basis_sift(self):
+        if self.sift_chunk > 0:
+            # Already sifted chunk by chunk while the qubits were received
+            return
         # print("Performing Basis sift...", end='\r')
 
-        receiver_basis = communication.receive_binary_list(self.cqc, self.sender_pkey)
+        sender_basis = communication.receive_bit_array(self.cqc, self.sender_pkey)
         communication.send_binary_list(self.cqc, self.sender, self.skey, self.basis_list)
 
-        diff_basis = []
-        for i in range(0, len(receiver_basis)):
-            if receiver_basis[i] != self.basis_list[i]:
-                diff_basis.append(i)
-
-        self.sifted_key = utils.remove_indices(self.raw_key, diff_basis)
-        self.sifted_basis = utils.remove_indices(self.basis_list, diff_basis)
+        self.sifted_key, self.sifted_basis = utils.sift(self.raw_key, self.basis_list, sender_basis)
         # print("Performing Basis sift... Done!")
 
     def _perform_error_estimation(self):
         # print('Performing error estimation...', end='\r')
 
-        error_estimation_indices = communication.receive_list(self.cqc, self.sender_pkey)
-        sender_key_part = communication.receive_binary_list(self.cqc, self.sender_pkey)
+        seed = bytes.fromhex(communication.receive_message(self.cqc, self.sender_pkey))
+        sample_size = min(self.key_length, len(self.sifted_key))
+        error_estimation_indices = utils.sample_indices(seed, len(self.sifted_key), sample_size)
+        sender_key_part = communication.receive_bit_array(self.cqc, self.sender_pkey)
 
-        num_errors = 0.0
-        key_part = []
-        for i in range(0, len(error_estimation_indices)):
-            key_part.append(self.sifted_key[error_estimation_indices[i]])
-            if sender_key_part[i] != key_part[i]:
-                num_errors += 1.0
+        key_part = self.sifted_key.gather(error_estimation_indices)
+        num_errors = (sender_key_part ^ key_part).count()
 
         communication.send_binary_list(self.cqc, self.sender, self.skey, key_part)
 
@@ -156,30 +273,46 @@ class Receiver(object):
         # print('B Performing error estimation... Done!')
         # print('B Error rate = {}'.format(self.error_estimation))
 
-        error_estimation_indices.sort()
         self.sifted_key = utils.remove_indices(self.sifted_key, error_estimation_indices)
         remaining_bits = len(self.sifted_key)
         min_entropy = remaining_bits * (1 - utils.h(self.error_estimation))
-        max_key = min_entropy - 2 * utils.log(1/self.security_param, 2) - 1
+        self.max_key_length = min_entropy - 2 * utils.log(1/self.security_param, 2) - 1
 
-        return self.n <= max_key
+        return self.key_length <= self.max_key_length
 
     def _perform_error_correction(self):
-        if self.error_estimation == 0:
+        if self.error_estimation == 0 and not (self.adaptive_error_correction and
+                                               self.error_correction_engine == 'cascade'):
             self.error_estimation = 0.01
-        CascadeReceiver(self).run_algorithm()
+        ENGINES[self.error_correction_engine][1](self, self.batched_error_correction,
+                                                 self.adaptive_error_correction).run_algorithm()
 
     def _perform_privacy_amplification(self):
-        seed = communication.receive_binary_list(self.cqc, self.sender_pkey)
-        seed_col = seed[:self.n]
-        seed_row = seed[self.n:]
-        self.final_key = matmul(toeplitz(seed_col, seed_row), self.sifted_key)
-
-    def _decrypt(self, cyphertext):
-        plaintext = []
-        for i in range(0, len(cyphertext)):
-            plaintext.append((cyphertext[i] + self.final_key[i]) % 2)
-        return communication.bitlist_to_bytes(plaintext)
+        if self.compressed_seed:
+            seed = bytes.fromhex(communication.receive_message(self.cqc, self.sender_pkey))
+            seed = utils.expand_seed(seed, self.key_length + len(self.sifted_key))
+        else:
+            seed = communication.receive_bit_array(self.cqc, self.sender_pkey)
+        self.final_key = block_toeplitz_hash(seed, self.sifted_key, self.key_length, self.privacy_amplification_blocks,
+                                             self.config.get_privacy_amplification_workers())
+
+    def _decrypt(self, cyphertext, offset=0):
+        """
+        :param offset: position of cyphertext in the message in bytes
+        """
+        return utils.one_time_pad(cyphertext, self.final_key[8 * offset:])
+
+    def _receive_encrypted_chunks(self, f):
+        """
+        Decrypt the chunks of the message as they arrive and write them to f, until all n bits have arrived.
+        """
+        offset = 0
+        while offset < self.n // 8:
+            cyphertext = communication.receive_bytes(self.cqc, self.sender_pkey)
+            if len(cyphertext) == 0:
+                raise ValueError('Empty chunk')
+            f.write(self._decrypt(cyphertext, offset))
+            offset += len(cyphertext)
 
 
 def main():
@@ -188,4 +321,5 @@ def main():
 
 
 ##################################################################################################
-main()
+if __name__ == '__main__':
+    main()
@@ -5,7 +5,6 @@ then
         kill -9 $TEST_PIDS
 fi
 
-rm *.pem
 python sender.py "$1" &
 python receiver.py &
 python eavesdropper.py $1 &
@@ -26,15 +26,20 @@
 # ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+import hmac
 import json
 import math
-from scipy.linalg import toeplitz
-from numpy import matmul
+import mmap
+import os
+
+import numpy as np
 
 from cqc.pythonLib import CQCConnection, qubit
 import communication
+from bit_array import BitArray
 import authentication as auth
-from error_correction import CascadeSender
+from error_correction import ENGINES
+from privacy_amplification import block_toeplitz_hash
 from config import Config
 from progress_bar import  print_progress_bar
 
@@ -53,54 +58,159 @@ class Sender(object):
 
         self.correctness_param = self.config.get_correctness_param()
         self.security_param = self.config.get_security_param()
-
-        self.skey = auth.generate_private_key()
+        self.window = self.config.get_qubit_window()
+        self.sift_chunk = self.config.get_sift_chunk()
+        self.authentication = self.config.get_authentication_mode()
+        self.replenish_bits = self.config.get_replenish_bits() if self.authentication == 'mac' else 0
+        self.transcript = self.config.get_transcript_authentication()
+        self.batched_error_correction = self.config.get_batched_error_correction()
+        self.adaptive_error_correction = self.config.get_adaptive_error_correction()
+        self.error_correction_engine = self.config.get_error_correction_engine()
+        self.compressed_seed = self.config.get_compressed_seed()
+        self.privacy_amplification_blocks = self.config.get_privacy_amplification_blocks()
+        self.encryption_chunk_size = self.config.get_encryption_chunk_size()
+
+        self.skey = auth.load_private_key(self.name)
         self.pkey = auth.publish_public_key(self.name, self.skey)
         self.receiver = ''
         self.receiver_pkey = ''
 
         self.n = 0
+        self.key_length = 0
         self.N = 0
 
-        self.raw_key = []
-        self.basis_list = []
-        self.sifted_key = []
-        self.sifted_basis = []
+        self.raw_key = BitArray()
+        self.basis_list = BitArray()
+        self.sifted_key = BitArray()
+        self.sifted_basis = BitArray()
+        self.num_sifted = 0
 
         self.error_estimation = 0.0
+        self.max_key_length = 0.0
 
     def send(self, filename, receiver='Bob'):
         with CQCConnection(self.name) as self.cqc:
             self.cqc.closeClassicalServer()
             self.receiver = receiver
-            self.receiver_pkey = auth.get_public_key(receiver)
 
             f = open(filename, 'rb')
-            message = f.read()
+            if self.encryption_chunk_size > 0 and os.fstat(f.fileno()).st_size > 0:
+                # The pages of the file are only read as the chunks are encrypted
+                message = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                message = f.read()
             f.close()
 
-            self.n = len(message)*8
-            self.N = math.ceil((4 + self.correctness_param) * self.n) + 25
-            communication.send_message(self.cqc, self.receiver, self.skey, json.dumps({
-                'n': self.n,
-                'security_param': self.security_param,
-                'correctness_param': self.correctness_param,
-                'filename': filename
-            }))
-            self._send_qubits()
-            self._perform_basis_sift()
-            can_continue = self._perform_error_estimation()
-            if not can_continue:
-                print('Not enough min entropy :(')
-                return
-            self._perform_error_correction()
-            self._perform_privacy_amplification()
+            try:
+                with communication.Channel(self.cqc, self.receiver, listen=False, framing=self.config.get_framing()):
+                    if self.config.get_key_exchange() == 'channel':
+                        self.receiver_pkey = communication.exchange_public_keys(self.cqc, self.receiver, self.pkey,
+                                                                                send_first=True)
+                    else:
+                        self.receiver_pkey = auth.get_public_key(receiver)
+                    self._run_protocol(filename, message)
+            finally:
+                if isinstance(message, mmap.mmap):
+                    message.close()
+
+    def _run_protocol(self, filename, message):
+        self.n = len(message)*8
+        self.key_length = self.n + self.replenish_bits
+        self.N = math.ceil((4 + self.correctness_param) * self.key_length) + 25
+        nonce = os.urandom(16)
+        communication.send_message(self.cqc, self.receiver, self.skey, json.dumps({
+            'n': self.n,
+            'authentication': self.authentication,
+            'replenish_bits': self.replenish_bits,
+            'nonce': nonce.hex(),
+            'transcript': self.transcript,
+            'security_param': self.security_param,
+            'correctness_param': self.correctness_param,
+            'window': self.window,
+            'sift_chunk': self.sift_chunk,
+            'batched_error_correction': self.batched_error_correction,
+            'adaptive_error_correction': self.adaptive_error_correction,
+            'error_correction_engine': self.error_correction_engine,
+            'compressed_seed': self.compressed_seed,
+            'privacy_amplification_blocks': self.privacy_amplification_blocks,
+            'encryption_chunk_size': self.encryption_chunk_size,
+            'filename': filename
+        }))
+        if self.authentication == 'mac':
+            self._start_mac_authentication(nonce)
+        if self.transcript:
+            self.skey = auth.TranscriptKey(self.skey)
+            self.receiver_pkey = auth.TranscriptKey(self.receiver_pkey)
+        self._send_qubits()
+        # No basis may be revealed before what the peer said about the qubits has been authenticated
+        self.authenticate_phase('qubits')
+        self._perform_basis_sift()
+        self.authenticate_phase('sift')
+        can_continue = self._perform_error_estimation()
+        self.authenticate_phase('error estimation')
+        if not can_continue:
+            print('Not enough min entropy :(')
+            return
+        self._perform_error_correction()
+        if self.authentication == 'mac' and not self._confirm_keys():
+            return
+        self._perform_privacy_amplification()
+        self.authenticate_phase('privacy amplification')
+        if self.encryption_chunk_size > 0:
+            self._send_encrypted_chunks(message)
+        else:
             cyphertext = self._encrypt(message)
-            communication.send_binary_list(self.cqc, self.receiver, self.skey, cyphertext)
+            communication.send_bytes(self.cqc, self.receiver, self.skey, cyphertext)
+        self.authenticate_phase('encryption')
+        if self.authentication == 'mac':
+            self._replenish_mac_secret()
+
+    def authenticate_phase(self, phase):
+        communication.authenticate_transcript(self.cqc, self.receiver, self.skey, self.receiver_pkey, phase,
+                                              send_first=True)
+
+    def _start_mac_authentication(self, nonce):
+        secret = auth.load_mac_secret(self.config.get_mac_secret_file(self.name))
+        self.skey = auth.MacKey(secret, nonce, self.name + '->' + self.receiver)
+        self.receiver_pkey = auth.MacKey(secret, nonce, self.receiver + '->' + self.name)
+
+    def _confirm_keys(self):
+        """
+        Check a hash of the receiver's reconciled key against ours before privacy amplification, so that the MAC
+        secret can only be replaced by a key both parties share. The hash reveals 8 * utils.CONFIRMATION_BYTES bits
+        of the key, which are taken from what privacy amplification may keep.
+        :return: True if the keys match and there is still enough min entropy for the final key
+        """
+        confirmation = communication.receive_list(self.cqc, self.receiver_pkey)
+        matched = hmac.compare_digest(utils.key_hash(bytes.fromhex(confirmation['seed']), self.sifted_key).hex(),
+                                      confirmation['hash'])
+        communication.send_message(self.cqc, self.receiver, self.skey, 'MATCH' if matched else 'MISMATCH')
+        self.authenticate_phase('key confirmation')
+        self.max_key_length -= 8 * utils.CONFIRMATION_BYTES
+        if not matched:
+            print('Reconciled keys differ :(')
+            return False
+        if self.key_length > self.max_key_length:
+            print('Not enough min entropy :(')
+            return False
+        return True
+
+    def _replenish_mac_secret(self):
+        """
+        Replace the MAC secret with the end of the final key once the receiver says it is done with the message, so
+        that a session the receiver aborted does not leave the parties with different secrets.
+        """
+        done = communication.receive_message(self.cqc, self.receiver_pkey) == 'DONE'
+        self.authenticate_phase('done')
+        if done:
+            auth.store_mac_secret(self.config.get_mac_secret_file(self.name), self.final_key[self.n:])
 
     def _send_qubits(self):
         print("Sending {} qubits...".format(self.N))
+        credit = 0
         for i in range(0, self.N):
+            if self.window > 0 and credit == 0:
+                credit = int(communication.receive_control(self.cqc))
 
             # Generate a key bit
             k = random.randint(0, 1)
@@ -119,88 +229,114 @@ class Sender(object):
                 q.H()
 
             self.cqc.sendQubit(q, "Eve")
-            qubit_received = communication.receive_message(self.cqc, self.receiver_pkey)
+            if self.window > 0:
+                credit -= 1
+            else:
+                qubit_received = communication.receive_message(self.cqc, self.receiver_pkey)
             print_progress_bar(i, self.N-1)
 
-        done_receiving = communication.receive_message(self.cqc, self.receiver_pkey)
-        assert done_receiving == 'DONE'
+            if self.sift_chunk > 0 and ((i + 1) % self.sift_chunk == 0 or i + 1 == self.N):
+                self._sift_chunk(i + 1)
+
+        if self.window > 0:
+            summary = communication.receive_list(self.cqc, self.receiver_pkey)
+            assert summary == {'status': 'DONE', 'received': self.N}
+        else:
+            done_receiving = communication.receive_message(self.cqc, self.receiver_pkey)
+            assert done_receiving == 'DONE'
+
+    def _sift_chunk(self, end):
+        start = self.num_sifted
+        # The receiver's signed bases show that it has measured the chunk, only then may ours be revealed
+        receiver_basis = communication.receive_bit_array(self.cqc, self.receiver_pkey)
+        self.authenticate_phase('qubits {}'.format(end))
+        communication.send_binary_list(self.cqc, self.receiver, self.skey, self.basis_list[start:end])
+
+        sifted_key, sifted_basis = utils.sift(self.raw_key[start:end], self.basis_list[start:end], receiver_basis)
+        self.sifted_key.extend(sifted_key)
+        self.sifted_basis.extend(sifted_basis)
+        self.num_sifted = end
 
     def _perform_basis_sift(self):
+        if self.sift_chunk > 0:
+            # Already sifted chunk by chunk while the qubits were sent
+            return
         print("Performing Basis sift...", end='\r')
 
         communication.send_binary_list(self.cqc, self.receiver, self.skey, self.basis_list)
-        receiver_basis = communication.receive_binary_list(self.cqc, self.receiver_pkey)
-
-        diff_basis = []
-        for i in range(0, len(receiver_basis)):
-            if receiver_basis[i] != self.basis_list[i]:
-                diff_basis.append(i)
+        receiver_basis = communication.receive_bit_array(self.cqc, self.receiver_pkey)
 
-        self.sifted_key = utils.remove_indices(self.raw_key, diff_basis)
-        self.sifted_basis = utils.remove_indices(self.basis_list, diff_basis)
+        self.sifted_key, self.sifted_basis = utils.sift(self.raw_key, self.basis_list, receiver_basis)
 
         print("Performing Basis sift... Done!")
 
     def _perform_error_estimation(self):
         print('Performing error estimation...', end='\r')
-        error_estimation_indices = []
-        key_part = []
-        for i in range(0, self.n):
-            r = random.randint(0, len(self.sifted_key) - 1)
-            while r in error_estimation_indices:
-                r = random.randint(0, len(self.sifted_key) - 1)
-            error_estimation_indices.append(r)
-            key_part.append(self.sifted_key[r])
-
-        communication.send_message(self.cqc, self.receiver, self.skey, error_estimation_indices)
+        # Only a short seed goes on the wire, both sides expand it into the same sample
+        seed = os.urandom(utils.SEED_BYTES)
+        sample_size = min(self.key_length, len(self.sifted_key))
+        error_estimation_indices = utils.sample_indices(seed, len(self.sifted_key), sample_size)
+        key_part = self.sifted_key.gather(error_estimation_indices)
+
+        communication.send_message(self.cqc, self.receiver, self.skey, seed.hex())
         communication.send_binary_list(self.cqc, self.receiver, self.skey, key_part)
-        receiver_key_part = communication.receive_binary_list(self.cqc, self.receiver_pkey)
+        receiver_key_part = communication.receive_bit_array(self.cqc, self.receiver_pkey)
 
-        num_errors = 0.0
-        for i in range(0, len(key_part)):
-            if receiver_key_part[i] != key_part[i]:
-                num_errors += 1.0
+        num_errors = (receiver_key_part ^ key_part).count()
 
         self.error_estimation = num_errors / len(key_part)
         print('Performing error estimation... Done!')
         print('Error rate = {}'.format(self.error_estimation))
 
-        error_estimation_indices.sort()
         self.sifted_key = utils.remove_indices(self.sifted_key, error_estimation_indices)
         remaining_bits = len(self.sifted_key)
         min_entropy = remaining_bits * (1 - utils.h(self.error_estimation))
-        max_key = min_entropy - 2 * utils.log(1/self.security_param, 2) - 1
+        self.max_key_length = min_entropy - 2 * utils.log(1/self.security_param, 2) - 1
 
-        return self.n <= max_key
+        return self.key_length <= self.max_key_length
 
     def _perform_error_correction(self):
-        if self.error_estimation == 0:
+        # Adaptive Cascade has block sizes for an estimate of 0, everything else needs some errors to size blocks
+        if self.error_estimation == 0 and not (self.adaptive_error_correction and
+                                               self.error_correction_engine == 'cascade'):
             self.error_estimation = 0.01
             print('Performing error correction with estimate=0.01')
         print('Performing error correction...', end='\r')
-        CascadeSender(self).run_algorithm()
-        print('Performing error correction... Done!')
+        engine = ENGINES[self.error_correction_engine][0](self, self.batched_error_correction,
+                                                          self.adaptive_error_correction)
+        engine.run_algorithm()
+        print('Performing error correction... Done! ({} bits leaked in {} round trips)'.format(engine.leaked_bits,
+                                                                                            engine.round_trips))
 
     def _perform_privacy_amplification(self):
-        seed_col, seed_row = self._generate_seed()
-        communication.send_binary_list(self.cqc, self.receiver, self.skey, seed_col + seed_row)
-        self.final_key = matmul(toeplitz(seed_col, seed_row), self.sifted_key)
-
-    def _generate_seed(self):
-        column = []
-        for i in range(0, self.n):
-            column.append(random.randint(0, 1))
-        row = []
-        for i in range(0, len(self.sifted_key)):
-            row.append(random.randint(0, 1))
-        return column, row
-
-    def _encrypt(self, plaintext):
-        bits_plaintext = communication.bytes_to_bitlist(plaintext)
-        cyphertext = []
-        for i in range(0, len(bits_plaintext)):
-            cyphertext.append((bits_plaintext[i] + self.final_key[i]) % 2)
-        return cyphertext
+        num_seed_bits = self.key_length + len(self.sifted_key)
+        if self.compressed_seed:
+            seed = os.urandom(utils.SEED_BYTES)
+            communication.send_message(self.cqc, self.receiver, self.skey, seed.hex())
+            toeplitz_seed = utils.expand_seed(seed, num_seed_bits)
+        else:
+            toeplitz_seed = self._generate_seed(num_seed_bits)
+            communication.send_binary_list(self.cqc, self.receiver, self.skey, toeplitz_seed)
+        self.final_key = block_toeplitz_hash(toeplitz_seed, self.sifted_key, self.key_length,
+                                             self.privacy_amplification_blocks,
+                                             self.config.get_privacy_amplification_workers())
+
+    def _generate_seed(self, num_bits):
+        """
+        :return: numpy uint8 array of num_bits random bits for the first column and row of the Toeplitz matrix
+        """
+        return np.unpackbits(np.frombuffer(os.urandom((num_bits + 7) // 8), dtype=np.uint8), count=num_bits)
+
+    def _encrypt(self, plaintext, offset=0):
+        """
+        :param offset: position of plaintext in the message in bytes
+        """
+        return utils.one_time_pad(plaintext, self.final_key[8 * offset:])
+
+    def _send_encrypted_chunks(self, message):
+        for start in range(0, len(message), self.encryption_chunk_size):
+            chunk = message[start:start + self.encryption_chunk_size]
+            communication.send_bytes(self.cqc, self.receiver, self.skey, self._encrypt(chunk, start))
 
 
               #####################################################################################################
@@ -223,4 +359,5 @@ def main():
     alice.send(filename, "Bob")
 
 ##################################################################################################
-main()
+if __name__ == '__main__':
+    main()
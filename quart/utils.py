@@ -1,5 +1,16 @@
+import hashlib
+import hmac
 import math
 
+import numpy as np
+
+import bit_array
+from bit_array import BitArray
+
+SEED_BYTES = 16
+# Length of the key hashes that confirm both parties hold the same key
+CONFIRMATION_BYTES = 8
+
 
 def log(x,base):
     if x == 0:
@@ -12,28 +23,128 @@ def h(p):
 
 
 def remove_indices(l, indices):
-    for indice in reversed(indices):
-        del l[indice]
+    """
+    :return: a copy of l without the elements at the given indices, which may be in any order
+    """
+    if isinstance(l, BitArray):
+        return l.delete(indices)
+    keep = np.ones(len(l), dtype=bool)
+    keep[np.asarray(indices, dtype=np.int64)] = False
+    return [element for element, kept in zip(l, keep) if kept]
+
+
+def shared_rng(seed):
+    """
+    Random generator expanded deterministically from a short seed, so that both parties can derive the same
+    random choices from it. Both sides need numpy's PCG64 generator. numpy only keeps the bit stream of PCG64 the
+    same across releases, not the algorithms behind the Generator methods (NEP 19), so shared choices have to be
+    built from raw_words alone.
+    :param seed: bytes
+    """
+    return np.random.Generator(np.random.PCG64(int.from_bytes(seed, 'big')))
+
+
+def raw_words(rng, n):
+    """
+    :return: numpy uint64 array of the next n outputs of the bit generator of rng
+    """
+    return rng.bit_generator.random_raw(n)
+
+
+def expand_seed(seed, num_bits):
+    """
+    Expand a short seed into num_bits pseudorandom bits with the SHAKE-256 extendable-output function.
+    :param seed: bytes
+    :return: numpy uint8 array of bits
+    """
+    digest = hashlib.shake_256(seed).digest((num_bits + 7) // 8)
+    return np.unpackbits(np.frombuffer(digest, dtype=np.uint8), count=num_bits)
+
+
+def one_time_pad(data, key_bits):
+    """
+    XOR data with the first len(data) bytes of the packed key bits, which encrypts and decrypts alike.
+    :param data: bytes
+    :param key_bits: numpy array of at least 8 * len(data) bits
+    :return: bytes
+    """
+    key = np.packbits(np.asarray(key_bits[:8 * len(data)], dtype=np.uint8))
+    return np.bitwise_xor(np.frombuffer(data, dtype=np.uint8), key).tobytes()
+
+
+def key_hash(seed, key):
+    """
+    Short hash of a key under a fresh seed, for the parties to confirm that they hold the same key. Every hash sent
+    leaks 8 * CONFIRMATION_BYTES bits about the key.
+    :param key: BitArray
+    """
+    return hmac.new(seed, key.to_bytes(), hashlib.sha256).digest()[:CONFIRMATION_BYTES]
+
+
+def sample_indices(seed, population, k):
+    """
+    Sample k distinct indices from range(population) without replacement, in O(population) time: the indices of the
+    k smallest of population random words, ties going to the lower index.
+    :return: sorted numpy array of indices
+    """
+    if k == 0:
+        return np.zeros(0, dtype=np.int64)
+    words = raw_words(shared_rng(seed), population)
+    threshold = np.partition(words, k - 1)[k - 1]
+    selected = words < threshold
+    selected[np.flatnonzero(words == threshold)[:k - np.count_nonzero(selected)]] = True
+    return np.flatnonzero(selected)
+
+
+def sift(key, basis, other_basis):
+    """
+    Keep only the positions where both parties measured in the same basis, with one comparison of the two basis
+    arrays and one compaction. The inputs are not modified.
+    :return: tuple (sifted key, sifted basis)
+    """
+    same_basis = ~(basis ^ other_basis)
+    return key.compress(same_basis), basis.compress(same_basis)
+
 
-    return l
+def seeded_permutation(seed, n):
+    """
+    :return: permutation of range(n) expanded from seed, see shared_rng
+    """
+    return random_permutation(shared_rng(seed), n)
 
 
-def calculate_parity(key, indexes):
-    parity = 0
-    for index in indexes:
-        parity = (parity + key[index]) % 2
-    return parity
+def random_permutation(rng, n):
+    """
+    Order range(n) by one raw random word per index. The index replaces the low bits of its word, so that all words
+    differ and any sort gives the same order, with the rare ties of the remaining bits going to the lower index.
+    :return: numpy int64 array
+    """
+    mask = np.uint64((1 << max(1, (n - 1).bit_length())) - 1)
+    words = raw_words(rng, n) & ~mask | np.arange(n, dtype=np.uint64)
+    words.sort()
+    return (words & mask).astype(np.int64)
 
 
-def calculate_parities(key, list_blocks):
-    parities = []
-    for block in list_blocks:
-        parities.append(calculate_parity(key, block))
-    return parities
+def random_below(rng, bound, size):
+    """
+    :return: numpy int64 array of size random integers in range(bound), taken from the top 53 bits of raw words
+    """
+    fractions = (raw_words(rng, size) >> np.uint64(11)).astype(np.float64) * 2.0 ** -53
+    return np.minimum((fractions * bound).astype(np.int64), bound - 1)
 
 
-def get_num_block_with_index(blocks, index):
-    for i in range(0, len(blocks)):
-        for ind in blocks[i]:
-            if ind == index:
-                return i
+def block_parities(bits, block_size):
+    """
+    Parities of all consecutive blocks of block_size bits, the last one possibly shorter, in one reduction over the
+    whole array. On a BitArray with a block size that is a multiple of 8, sums the popcounts of the packed bytes
+    instead of unpacking them.
+    :param bits: numpy array of bits or BitArray
+    :return: numpy uint8 array with one parity per block
+    """
+    if isinstance(bits, BitArray):
+        if block_size % 8 == 0:
+            popcounts = bit_array.popcount(bits.packed())
+            return (np.add.reduceat(popcounts, np.arange(0, len(popcounts), block_size // 8)) & 1).astype(np.uint8)
+        bits = bits.to_array()
+    bits = np.asarray(bits, dtype=np.uint8)
+    return np.bitwise_xor.reduceat(bits, np.arange(0, len(bits), block_size)) if len(bits) > 0 else bits